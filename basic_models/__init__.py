@@ -18,6 +18,8 @@
 
 
 
+default_app_config = 'basic_models.apps.BasicModelsConfig'
+
 # import all classes in here for convienence
 from basic_models.models import *
 from basic_models.managers import *
@@ -12,14 +12,62 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import time
+
+from autoslug import AutoSlugField
+from django.contrib import messages
 from django.contrib.admin import ModelAdmin
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import PermissionDenied
+from django.db import connections, router, transaction
+from django.db.models import Case, Value, When
+from django.db.models.fields import FieldDoesNotExist
+from django.utils.encoding import force_text
 from django.utils.translation import ugettext_lazy, ugettext as _
 try:
     from django.contrib.admin.utils import model_ngettext
 except ImportError:
     from django.contrib.admin.util import model_ngettext
 
-__all__ = ['UserModelAdmin', 'DefaultModelAdmin', 'SlugModelAdmin', 'OneActiveAdmin']
+from basic_models.caching import unpublish_keys
+from basic_models.changelog import batch_changes, record_changes
+from basic_models.instrumentation import get_collector, model_label
+from basic_models.managers import _auto_now_updates
+from basic_models.models import ChangeLogEntry
+from basic_models.paginator import ApproximateCountPaginator
+
+__all__ = ['UserModelAdmin', 'DefaultModelAdmin', 'SlugModelAdmin', 'OneActiveAdmin', 'ArchivedModelAdmin']
+
+
+class AuditChangeList(ChangeList):
+    """ChangeList that joins only the foreign keys it displays, and loads only the columns it displays when it can"""
+
+    def apply_select_related(self, qs):
+        if self.list_select_related is False:
+            related = [f.name for f in self._displayed_fields() if f.is_relation]
+            return qs.select_related(*related) if related else qs
+        return super(AuditChangeList, self).apply_select_related(qs)
+
+    def get_queryset(self, request):
+        qs = super(AuditChangeList, self).get_queryset(request)
+        columns = [name for name in self.list_display if name != 'action_checkbox']
+        fields = self._displayed_fields()
+        # only when every column is a plain field: callables and __str__ may read
+        # anything, and list_editable rows are saved back
+        if len(fields) == len(columns) and not self.list_editable:
+            qs = qs.only(*[f.name for f in fields])
+        return qs
+
+    def _displayed_fields(self):
+        fields = []
+        for name in self.list_display:
+            try:
+                field = self.lookup_opts.get_field(name)
+            except FieldDoesNotExist:
+                continue
+            if field.concrete and not field.many_to_many:
+                fields.append(field)
+        return fields
 
 
 class UserModelAdmin(ModelAdmin):
@@ -27,6 +75,12 @@ class UserModelAdmin(ModelAdmin):
     save_on_top = True
     readonly_fields = ('created_by', 'updated_by')
 
+    def get_changelist(self, request, **kwargs):
+        return AuditChangeList
+
+    # save inline rows with bulk INSERT/UPDATE statements instead of one save() per row
+    bulk_save_formsets = False
+
     def save_model(self, request, obj, form, change):
         instance = form.save(commit=False)
         self._update_instance(instance, request.user)
@@ -34,11 +88,73 @@ class UserModelAdmin(ModelAdmin):
         return instance
 
     def save_formset(self, request, form, formset, change):
-        instances = formset.save(commit=False)
-        for instance in instances:
-            self._update_instance(instance, request.user)
-            instance.save()
-        formset.save_m2m()
+        # the change log entries of every row go out in one bulk INSERT
+        with batch_changes():
+            if self.bulk_save_formsets:
+                return self._bulk_save_formset(request, formset)
+            instances = formset.save(commit=False)
+            for instance in instances:
+                self._update_instance(instance, request.user)
+                instance.save()
+            formset.save_m2m()
+
+    def _bulk_save_formset(self, request, formset):
+        """Save a formset in one transaction: one DELETE, bulk INSERTs for new rows and bulk UPDATEs for changed rows"""
+        model = formset.model
+        using = router.db_for_write(model)
+        manager = model._default_manager.db_manager(using)
+        with transaction.atomic(using=using):
+            formset.save(commit=False)
+            new_objects = list(formset.new_objects)
+            changed_objects = [obj for obj, changed in formset.changed_objects]
+            for instance in new_objects + changed_objects:
+                self._update_instance(instance, request.user)
+
+            change_log = getattr(model, 'change_log', False)
+            deleted_objects = [obj for obj in formset.deleted_objects if obj.pk is not None]
+            entries = [obj.change_log_entry(ChangeLogEntry.DELETION) for obj in deleted_objects] if change_log else []
+            deleted = [obj.pk for obj in deleted_objects]
+            if deleted:
+                manager.filter(pk__in=deleted).delete()
+
+            # save_m2m() and the change log need primary keys, which most backends
+            # can't return from a bulk INSERT
+            m2m_fields = [f for f in model._meta.many_to_many if f.name in formset.form.base_fields]
+            can_return_ids = getattr(connections[using].features, 'can_return_ids_from_bulk_insert', False)
+            saved_one_by_one = [obj for obj in new_objects if (m2m_fields or change_log) and not can_return_ids]
+            # AutoSlugField only fills in a blank slug on save()
+            saved_one_by_one += [obj for obj in changed_objects if _has_blank_slug(obj)]
+            for instance in saved_one_by_one:
+                instance.save()
+
+            to_create = [obj for obj in new_objects if obj not in saved_one_by_one]
+            if to_create:
+                if hasattr(manager, 'bulk_create_with_slugs'):
+                    manager.bulk_create_with_slugs(to_create)
+                else:
+                    manager.bulk_create(to_create)
+
+            to_update = [obj for obj in changed_objects if obj not in saved_one_by_one]
+            if to_update:
+                fields = _changed_fields(model, formset)
+                _bulk_update(manager, to_update, fields)
+                if hasattr(model, 'publish_many'):
+                    model.publish_many(to_update + [obj for obj in to_create if obj.pk is not None])
+                if change_log:
+                    names = [f.name for f in fields]
+                    entries += [obj.change_log_entry(ChangeLogEntry.CHANGE, names) for obj in to_update]
+            if change_log:
+                # the rows saved one by one logged themselves
+                entries += [obj.change_log_entry(ChangeLogEntry.ADDITION) for obj in to_create]
+                record_changes([entry for entry in entries if entry is not None], using)
+
+            formset.save_m2m()
+
+        collector = get_collector()
+        if collector is not None:
+            collector.incr('admin.save_formset.created', len(new_objects), model_label(model))
+            collector.incr('admin.save_formset.updated', len(changed_objects), model_label(model))
+            collector.incr('admin.save_formset.deleted', len(deleted), model_label(model))
 
     @staticmethod
     def _update_instance(instance, user):
@@ -47,26 +163,99 @@ class UserModelAdmin(ModelAdmin):
         instance.updated_by = user
 
 
+def _has_blank_slug(instance):
+    return any(isinstance(f, AutoSlugField) and not getattr(instance, f.attname)
+               for f in instance._meta.concrete_fields)
+
+
+def _changed_fields(model, formset):
+    """Return the concrete fields the changed rows of formset need written back"""
+    names = set(['updated_by'])
+    for obj, changed in formset.changed_objects:
+        names.update(changed)
+    return [f for f in model._meta.concrete_fields
+            if not f.primary_key and (f.name in names or getattr(f, 'auto_now', False))]
+
+
+def _bulk_update(queryset, objs, fields):
+    """Write fields of objs back with one UPDATE per batch"""
+    for field in fields:
+        if getattr(field, 'auto_now', False):
+            for obj in objs:
+                setattr(obj, field.attname, field.pre_save(obj, False))
+    if hasattr(queryset, 'bulk_update'):
+        # Django 2.2+
+        return queryset.bulk_update(objs, [f.name for f in fields])
+
+    connection = connections[queryset.db]
+    batch_size = max(connection.ops.bulk_batch_size(['pk', 'pk'] + fields, objs), 1)
+    for i in range(0, len(objs), batch_size):
+        batch = objs[i:i + batch_size]
+        updates = {}
+        for field in fields:
+            whens = [When(pk=obj.pk, then=Value(getattr(obj, field.attname), output_field=field)) for obj in batch]
+            updates[field.attname] = Case(*whens, output_field=field)
+        batch_queryset = queryset.filter(pk__in=[obj.pk for obj in batch])
+        if hasattr(batch_queryset, '_update_published'):
+            # the caller publishes objs again, so their cache entries needn't be looked up
+            batch_queryset._update_published(None, **updates)
+        else:
+            batch_queryset.update(**updates)
+
+
 class ActiveModelAdmin(ModelAdmin):
     """ModelAdmin subclass that adds activate and delete actions and situationally removes the delete action"""
     actions = ['activate_objects', 'deactivate_objects']
 
+    # rows updated per UPDATE statement by the activate/deactivate actions
+    action_chunk_size = 1000
+
     def activate_objects(self, request, queryset):
         """Admin action to set is_active=True on objects"""
-        count = queryset.update(is_active=True)
-        self.message_user(request, _("Successfully activated %(count)d %(items)s.") % {
-            "count": count, "items": model_ngettext(self.opts, count)
+        count, elapsed = self._set_active(queryset, True)
+        self.message_user(request, _("Successfully activated %(count)d %(items)s in %(seconds).2f seconds.") % {
+            "count": count, "items": model_ngettext(self.opts, count), "seconds": elapsed
         })
     activate_objects.short_description = "Activate selected %(verbose_name_plural)s"
 
     def deactivate_objects(self, request, queryset):
         """Admin action to set is_active=False on objects"""
-        count = queryset.update(is_active=False)
-        self.message_user(request, _("Successfully deactivated %(count)d %(items)s.") % {
-            "count": count, "items": model_ngettext(self.opts, count)
+        count, elapsed = self._set_active(queryset, False)
+        self.message_user(request, _("Successfully deactivated %(count)d %(items)s in %(seconds).2f seconds.") % {
+            "count": count, "items": model_ngettext(self.opts, count), "seconds": elapsed
         })
     deactivate_objects.short_description = "Deactivate selected %(verbose_name_plural)s"
 
+    def _set_active(self, queryset, is_active):
+        """Update is_active in chunks, dropping the cache entries published for each chunk; returns (count, seconds)"""
+        start = time.time()
+        model = queryset.model
+        published_keys = getattr(model, 'published_keys', None)
+        if published_keys is not None:
+            rows = list(queryset.order_by().values(*model.cache_lookup_fields()))
+        else:
+            rows = [{'pk': pk} for pk in queryset.order_by().values_list('pk', flat=True)]
+
+        count = 0
+        for i in range(0, len(rows), self.action_chunk_size):
+            chunk = rows[i:i + self.action_chunk_size]
+            updates = dict(_auto_now_updates(model), is_active=is_active)
+            chunk_queryset = model._default_manager.using(queryset.db).filter(pk__in=[row['pk'] for row in chunk])
+            if hasattr(chunk_queryset, '_update_published'):
+                # the lookup values are in hand, so update() needn't read them again
+                count += chunk_queryset._update_published(chunk if published_keys is not None else None, **updates)
+            else:
+                count += chunk_queryset.update(**updates)
+                if published_keys is not None:
+                    unpublish_keys(published_keys(chunk), queryset.db)
+        elapsed = time.time() - start
+        collector = get_collector()
+        if collector is not None:
+            action = 'activate' if is_active else 'deactivate'
+            collector.incr('admin.%s.rows' % action, count, model_label(model))
+            collector.timing('admin.%s' % action, elapsed, model_label(model))
+        return count, elapsed
+
     def get_actions(self, request):
         actions = super(ActiveModelAdmin, self).get_actions(request)
         if not self.has_delete_permission(request):
@@ -75,6 +264,60 @@ class ActiveModelAdmin(ModelAdmin):
         return actions
 
 
+class ArchivedModelAdmin(ModelAdmin):
+    """Read-only ModelAdmin for the <Name>Archive model of a model with archive_after; its one action restores rows"""
+    actions = ['restore_objects']
+    list_display = ('archived_object', 'updated_at')
+
+    def archived_object(self, obj):
+        live = obj._archive_of._default_manager.db_manager(obj._state.db)
+        return force_text(live._from_archive(obj))
+    archived_object.short_description = ugettext_lazy('object')
+
+    def restore_objects(self, request, queryset):
+        """Admin action to move the selected rows back into the table and activate them"""
+        live = self.model._archive_of
+        manager = live._default_manager.db_manager(queryset.db)
+        live_admin = self.admin_site._registry.get(live)
+        if not isinstance(live_admin, ActiveModelAdmin):
+            live_admin = ActiveModelAdmin(live, self.admin_site)
+        pks = list(queryset.values_list('pk', flat=True))
+        with transaction.atomic(using=queryset.db):
+            restored = manager.restore_archived(pks)
+            live_admin._set_active(manager.filter(pk__in=pks), True)
+        self.message_user(request, _("Successfully restored %(count)d %(items)s.") % {
+            "count": restored, "items": model_ngettext(live._meta, restored)
+        })
+        if restored < len(pks):
+            skipped = len(pks) - restored
+            self.message_user(request, _("%(count)d %(items)s were left in the archive: live rows have taken their "
+                                         "unique values.") % {
+                "count": skipped, "items": model_ngettext(live._meta, skipped)
+            }, messages.WARNING)
+    restore_objects.short_description = ugettext_lazy("Restore selected %(verbose_name_plural)s")
+
+    def get_readonly_fields(self, request, obj=None):
+        return [field.name for field in self.model._meta.concrete_fields]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def get_actions(self, request):
+        actions = super(ArchivedModelAdmin, self).get_actions(request)
+        if 'delete_selected' in actions:
+            del actions['delete_selected']
+        return actions
+
+    def change_view(self, request, object_id, *args, **kwargs):
+        # archived rows are changed by restoring them first
+        if request.method == 'POST':
+            raise PermissionDenied
+        return super(ArchivedModelAdmin, self).change_view(request, object_id, *args, **kwargs)
+
+
 class TimestampedModelAdmin(ModelAdmin):
     """ModelAdmin subclass that will set created_at and updated_at fields to readonly"""
     readonly_fields = ('created_at', 'updated_at')
@@ -91,6 +334,9 @@ class DefaultModelAdmin(ActiveModelAdmin, UserModelAdmin, TimestampedModelAdmin)
 class SlugModelAdmin(DefaultModelAdmin):
     prepopulated_fields = {"slug": ("name",)}
     list_display = ('name', 'slug', 'is_active')
+    paginator = ApproximateCountPaginator
+    # the unfiltered total would be a second COUNT(*) of the whole table
+    show_full_result_count = False
     fieldsets = (
         (None, {'fields': ('name', 'slug')}),
     ) + DefaultModelAdmin.fieldsets
@@ -98,7 +344,7 @@ class SlugModelAdmin(DefaultModelAdmin):
 
 class OneActiveAdmin(ModelAdmin):
     save_on_top = True
-    list_display = ('__unicode__', 'is_active')
+    list_display = ('__str__', 'is_active')
     change_form_template = "admin/preview_change_form.html"
     actions = ['duplicate']
 
@@ -0,0 +1,187 @@
+# Copyright 2011 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Async counterparts of the manager methods, for ASGI views.
+
+Python 3.6+ only; basic_models.managers mixes these in when this module can
+be imported. Django's async cache (4.0+) and ORM (4.1+) methods are used when
+they exist, otherwise the sync ones run through sync_to_async().
+"""
+
+import asyncio
+import time
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+
+from basic_models.caching import (MISSING, entry_timeout, get_local_cache, get_versions, join_versions, publish_items,
+                                  refresh_time, set_packed)
+from basic_models.instrumentation import get_collector, model_label
+
+
+_flights = weakref.WeakKeyDictionary()
+
+
+async def single_flight(key, factory):
+    """Await factory(), sharing one call between every coroutine that asks for key while it runs"""
+    loop = asyncio.get_event_loop()
+    flights = _flights.setdefault(loop, {})
+    task = flights.get(key)
+    if task is None:
+        task = flights[key] = asyncio.ensure_future(factory())
+        task.add_done_callback(lambda done: flights.pop(key, None))
+    # a cancelled caller must not cancel the lookup the others are waiting on
+    return await asyncio.shield(task)
+
+
+async def acache(method, *args):
+    """Call cache.<method>(*args) without blocking the event loop"""
+    amethod = getattr(cache, 'a' + method, None)
+    if amethod is not None:
+        return await amethod(*args)
+    return await sync_to_async(getattr(cache, method))(*args)
+
+
+async def aget_or_rebuild(key, arebuild, timeout, refresh_by=None):
+    """caching.get_or_rebuild() with an async rebuild"""
+    return (await aget_or_rebuild_entry(key, arebuild, timeout, refresh_by))[0]
+
+
+async def aget_or_rebuild_entry(key, arebuild, timeout, refresh_by=None):
+    """caching.get_or_rebuild_entry() with an async rebuild"""
+    lock_key = '%s:lock' % key
+    lock_timeout = getattr(settings, 'BASIC_MODELS_REBUILD_LOCK_TIMEOUT', 10)
+    entry = await acache('get', key)
+    if entry is not None:
+        if time.time() < entry[1] or not await acache('add', lock_key, 1, lock_timeout):
+            return entry
+    elif not await acache('add', lock_key, 1, lock_timeout):
+        deadline = time.time() + getattr(settings, 'BASIC_MODELS_REBUILD_WAIT', 1.0)
+        while time.time() < deadline:
+            await asyncio.sleep(0.05)
+            entry = await acache('get', key)
+            if entry is not None:
+                return entry
+        value = await arebuild()
+        return value, refresh_time(time.time(), timeout, refresh_by)
+
+    try:
+        value = await arebuild()
+        now = time.time()
+        entry = (value, refresh_time(now, timeout, refresh_by))
+        await sync_to_async(set_packed)(key, entry, entry_timeout(now, entry[1]))
+    finally:
+        await acache('delete', lock_key)
+    return entry
+
+
+async def afirst(queryset):
+    if hasattr(queryset, 'afirst'):
+        return await queryset.afirst()
+    return await sync_to_async(queryset.first)()
+
+
+class AsyncActiveQuerySetMixin(object):
+    async def aiter_active(self, size=1000):
+        """Iterate the active rows from async code, fetching them in keyset chunks of size rows"""
+        chunks = self.iter_active_chunks(size)
+        while True:
+            chunk = await sync_to_async(next)(chunks, None)
+            if chunk is None:
+                return
+            for instance in chunk:
+                yield instance
+
+
+class AsyncOnlyOneActiveManagerMixin(object):
+    async def aget_active(self, prefetch=None, **scope):
+        """get_active() for async code; concurrent callers share one lookup"""
+        prefetch = self._active_prefetch(prefetch)
+        scope = self._active_scope(scope)
+        return await single_flight(('active', self._active_local_key(prefetch, scope)),
+                                   lambda: self._aget_active(prefetch, scope))
+
+    async def _aget_active(self, prefetch, scope):
+        namespace = self._active_local_key(prefetch, scope)
+        local = get_local_cache()
+        collector = get_collector()
+        if local is not None:
+            active = local.get_fresh(namespace)
+            if active is not MISSING:
+                if collector is not None:
+                    collector.incr('get_active.local_hit', model=model_label(self.model))
+                return active
+
+        version_keys = self._active_version_keys(scope)
+        version = join_versions(version_keys, await acache('get_many', version_keys))
+        if version is None:
+            version = await sync_to_async(get_versions)(version_keys)
+        if local is not None:
+            active, version = local.get(namespace, lambda: version)
+            if active is not MISSING:
+                if collector is not None:
+                    collector.incr('get_active.local_hit', model=model_label(self.model))
+                return active
+
+        timeout = self._active_timeout(prefetch)
+        rebuilt = []
+        transitions = []
+
+        async def rebuild():
+            rebuilt.append(time.time())
+            try:
+                active, transition = await self._afind_scheduled_active(prefetch, scope)
+                transitions.append(transition)
+                return active
+            finally:
+                if collector is not None:
+                    collector.timing('get_active.rebuild', time.time() - rebuilt[0], model_label(self.model))
+
+        active, refresh_at = await aget_or_rebuild_entry(
+            self._active_cache_key(version, prefetch, scope), rebuild, timeout, lambda: transitions[-1])
+        if collector is not None:
+            collector.incr('get_active.miss' if rebuilt else 'get_active.hit', model=model_label(self.model))
+        if local is not None:
+            local.set(namespace, version, active, self._local_timeout(prefetch, refresh_at))
+        return active
+
+    async def _afind_active(self, prefetch=(), scope=()):
+        return (await self._afind_scheduled_active(prefetch, scope))[0]
+
+    async def _afind_scheduled_active(self, prefetch=(), scope=()):
+        if prefetch or self._scheduled():
+            # prefetch_related() and aggregate() have no async counterpart everywhere
+            return await sync_to_async(self._find_scheduled_active)(prefetch, scope)
+        return await afirst(self._active_candidates(scope)), None
+
+
+class AsyncSlugModelManagerMixin(object):
+    async def aget_by_natural_key(self, slug):
+        """get_by_natural_key() for async code; concurrent callers share one lookup"""
+        return await single_flight(('natural_key', self.model, self.db, slug), lambda: self._aget_by_natural_key(slug))
+
+    async def _aget_by_natural_key(self, slug):
+        if self._uses_published_cache():
+            instance = await acache('get', self._slug_key(slug))
+            if instance is not None and instance.slug == slug:
+                return instance
+        if hasattr(self, 'aget'):
+            instance = await self.aget(slug=slug)
+        else:
+            instance = await sync_to_async(self.get)(slug=slug)
+        if self._uses_published_cache():
+            await sync_to_async(publish_items)({self._slug_key(slug): instance}, self.db)
+        return instance
@@ -0,0 +1,406 @@
+# Copyright 2011 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import pickle
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import setting_changed
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from basic_models.instrumentation import get_collector
+from cachemodel import CACHE_FOREVER_TIMEOUT
+
+
+MISSING = object()
+
+_packing = threading.local()
+
+
+def on_commit(func, using=None):
+    """Run func once the current transaction commits, or right away outside of one"""
+    if hasattr(transaction, 'on_commit'):
+        transaction.on_commit(func, using=using)
+    else:
+        # Django < 1.9 has no commit hooks
+        func()
+
+
+@contextmanager
+def packing():
+    """Pickle the ActiveModel instances cached inside the block in their compact form"""
+    previous = getattr(_packing, 'active', False)
+    _packing.active = True
+    try:
+        yield
+    finally:
+        _packing.active = previous
+
+
+def is_packing():
+    return getattr(_packing, 'active', False)
+
+
+def compress(value, threshold):
+    """Return ('z', compressed pickle) if value pickles to threshold bytes or more, otherwise ('', value)"""
+    if threshold is not None:
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) >= threshold:
+            return ('z', zlib.compress(data))
+    return ('', value)
+
+
+def decompress(entry):
+    """Reverse compress()"""
+    if entry[0] == 'z':
+        return pickle.loads(zlib.decompress(entry[1]))
+    return entry[1]
+
+
+def set_many(items, timeout=CACHE_FOREVER_TIMEOUT):
+    """cache.set_many() in chunks of BASIC_MODELS_PUBLISH_BATCH_SIZE keys"""
+    keys = list(items)
+    batch_size = getattr(settings, 'BASIC_MODELS_PUBLISH_BATCH_SIZE', 500)
+    start = time.time()
+    with packing():
+        for i in range(0, len(keys), batch_size):
+            cache.set_many(dict((key, items[key]) for key in keys[i:i + batch_size]), timeout)
+    collector = get_collector()
+    if collector is not None:
+        collector.incr('publish.keys', len(keys))
+        collector.timing('publish.set_many', time.time() - start)
+
+
+class BufferedWrites(object):
+    """Writes held until the outermost batch() block exits, or until the current
+    transaction commits and dropped if it rolls back (Django >= 1.9). Outside of
+    both they are written right away.
+
+    The values held for a database are collected in a factory() container, a
+    dict or a list, and handed to write(values, using) in one call.
+    """
+
+    def __init__(self, name, factory, write):
+        self.name = name
+        self.factory = factory
+        self.write = write
+        self._batches = threading.local()
+
+    def add(self, values, using=None):
+        if not values:
+            return
+        stack = getattr(self._batches, 'stack', None)
+        if stack:
+            self._extend(stack[-1].setdefault(using, self.factory()), values)
+        elif hasattr(transaction, 'on_commit') and connections[using or DEFAULT_DB_ALIAS].in_atomic_block:
+            self._extend(self._commit_buffer(using or DEFAULT_DB_ALIAS), values)
+        else:
+            self.write(values, using)
+
+    @contextmanager
+    def batch(self):
+        stack = self._batches.__dict__.setdefault('stack', [])
+        stack.append({})
+        try:
+            yield
+        except Exception:
+            stack.pop()
+            raise
+        batch = stack.pop()
+        for using, values in batch.items():
+            self.add(values, using)
+
+    def held(self, using=None):
+        """Every container of values not written yet: those of the open batch() blocks, and the commit buffers of using"""
+        for batch in getattr(self._batches, 'stack', ()):
+            for values in batch.values():
+                yield values
+        for values, flush in self._buffers(using or DEFAULT_DB_ALIAS).values():
+            yield values
+
+    def _extend(self, held, values):
+        if isinstance(held, dict):
+            held.update(values)
+        else:
+            held.extend(values)
+
+    def _buffers(self, using):
+        return connections[using].__dict__.setdefault('_basic_models_%s_buffers' % self.name, {})
+
+    def _commit_buffer(self, using):
+        # one buffer per savepoint, so rolling a savepoint back drops its callback and its values
+        connection = connections[using]
+        buffers = self._buffers(using)
+        savepoint = tuple(connection.savepoint_ids)
+        held = buffers.get(savepoint)
+        if held is None or not any(entry[1] is held[1] for entry in connection.run_on_commit):
+            values = self.factory()
+
+            def flush():
+                if buffers.get(savepoint) is held:
+                    del buffers[savepoint]
+                self.write(values, using)
+            held = buffers[savepoint] = (values, flush)
+            transaction.on_commit(flush, using=using)
+        return held[0]
+
+
+_publishes = BufferedWrites('publish', dict, lambda items, using: set_many(items))
+
+
+def publish_items(items, using=None):
+    """Cache items, a {key: value} dict, forever.
+
+    Inside batch_publish() the items are held until the outermost block exits.
+    Inside a transaction they are held until it commits, and dropped if it rolls
+    back (Django >= 1.9). Otherwise they are written right away.
+    """
+    _publishes.add(items, using)
+
+
+def unpublish_keys(keys, using=None):
+    """Delete keys from the cache, dropping any publish of them still held by
+    batch_publish() or an open transaction so it can't be written back later.
+    Inside a transaction the keys are deleted again when it commits (Django >= 1.9).
+    """
+    keys = list(keys)
+    if not keys:
+        return
+    for items in _publishes.held(using):
+        for key in keys:
+            items.pop(key, None)
+    cache.delete_many(keys)
+    if hasattr(transaction, 'on_commit') and connections[using or DEFAULT_DB_ALIAS].in_atomic_block:
+        # until the commit, readers see the old rows and may cache them again
+        transaction.on_commit(lambda: cache.delete_many(keys), using=using)
+
+
+def batch_publish():
+    """Coalesce every publish inside the block into batched set_many() calls"""
+    return _publishes.batch()
+
+
+def get_version(key):
+    """Return the current value of a version counter, starting one if it is missing"""
+    version = cache.get(key)
+    if version is None:
+        # start from the clock so an evicted counter can't fall back onto old entries
+        version = int(time.time() * 1000)
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+def get_versions(keys):
+    """get_version() for several counters in one round trip, combined into a single version"""
+    if len(keys) == 1:
+        return get_version(keys[0])
+    version = join_versions(keys, cache.get_many(keys))
+    if version is None:
+        version = join_versions(keys, dict((key, get_version(key)) for key in keys))
+    return version
+
+
+def join_versions(keys, found):
+    """Combine the counters in found, a {key: value} dict, the way get_versions() does; None if one is missing"""
+    if any(found.get(key) is None for key in keys):
+        return None
+    if len(keys) == 1:
+        return found[keys[0]]
+    return '.'.join(str(found[key]) for key in keys)
+
+
+def bump_version(key):
+    """Move a version counter forward, orphaning every entry keyed by the old version"""
+    try:
+        cache.incr(key)
+    except ValueError:
+        get_version(key)
+
+
+def get_or_rebuild(key, rebuild, timeout, refresh_by=None):
+    """Return the value cached at key, calling rebuild() to refresh it when it is missing or stale.
+
+    Entries outlive their timeout by BASIC_MODELS_STALE_TIMEOUT seconds. Only the
+    process that wins a cache.add() lock rebuilds; the others keep serving the
+    stale value, or wait up to BASIC_MODELS_REBUILD_WAIT seconds for a fresh one.
+    refresh_by, when given, is called after a rebuild and returns a time.time()
+    the new value must be refreshed by sooner than timeout, or None.
+    """
+    return get_or_rebuild_entry(key, rebuild, timeout, refresh_by)[0]
+
+
+def get_or_rebuild_entry(key, rebuild, timeout, refresh_by=None):
+    """get_or_rebuild(), returning the (value, time it is due for a refresh) entry"""
+    lock_key = '%s:lock' % key
+    lock_timeout = getattr(settings, 'BASIC_MODELS_REBUILD_LOCK_TIMEOUT', 10)
+    entry = cache.get(key)
+    if entry is not None:
+        if time.time() < entry[1] or not cache.add(lock_key, 1, lock_timeout):
+            return entry
+    elif not cache.add(lock_key, 1, lock_timeout):
+        entry = _wait_for(key)
+        if entry is not None:
+            return entry
+        # whoever holds the lock is taking too long, don't queue behind them
+        value = rebuild()
+        return value, refresh_time(time.time(), timeout, refresh_by)
+
+    try:
+        value = rebuild()
+        now = time.time()
+        entry = (value, refresh_time(now, timeout, refresh_by))
+        set_packed(key, entry, entry_timeout(now, entry[1]))
+    finally:
+        cache.delete(lock_key)
+    return entry
+
+
+def refresh_time(now, timeout, refresh_by=None):
+    """When a value rebuilt at now is due for a refresh: timeout seconds later, or refresh_by() if that is sooner"""
+    refresh_at = now + timeout
+    if refresh_by is not None:
+        refresh_at = min(refresh_at, refresh_by() or refresh_at)
+    return refresh_at
+
+
+def entry_timeout(now, refresh_at):
+    """The cache timeout of an entry due for a refresh at refresh_at, kept BASIC_MODELS_STALE_TIMEOUT longer"""
+    return max(int(math.ceil(refresh_at - now)), 0) + getattr(settings, 'BASIC_MODELS_STALE_TIMEOUT', 60)
+
+
+def set_packed(key, value, timeout):
+    """cache.set() inside packing()"""
+    with packing():
+        cache.set(key, value, timeout)
+
+
+def _wait_for(key):
+    deadline = time.time() + getattr(settings, 'BASIC_MODELS_REBUILD_WAIT', 1.0)
+    while time.time() < deadline:
+        time.sleep(0.05)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry
+    return None
+
+
+class LocalCache(object):
+    """A bounded, thread-safe LRU of decoded values held in process memory.
+
+    Every entry remembers the shared version counter it was built from. Within
+    `grace` seconds of its last check an entry is served without touching the
+    shared cache; after that it costs one GET of the version counter. Entries
+    are dropped after `timeout` seconds regardless.
+    """
+
+    def __init__(self, max_entries=100, timeout=300, grace=1.0):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.grace = grace
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, get_version):
+        """Return (value, version) for key.
+
+        value is MISSING unless the entry was built from the current version, in
+        which case the caller should rebuild it. version is whatever
+        get_version() returned, or None if the grace window made the check
+        unnecessary.
+        """
+        value = self.get_fresh(key)
+        if value is not MISSING:
+            return value, None
+        now = time.time()
+        version = get_version()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now < entry[2] and entry[0] == version:
+                self._entries.pop(key)
+                self._entries[key] = (entry[0], entry[1], entry[2], now)
+                self.hits += 1
+                return entry[1], version
+            self.misses += 1
+            return MISSING, version
+
+    def get_fresh(self, key):
+        """Return the value for key if it is within its grace window, otherwise MISSING; never checks the version"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now < entry[2] and now - entry[3] < self.grace:
+                self._entries[key] = self._entries.pop(key)
+                self.hits += 1
+                return entry[1]
+        return MISSING
+
+    def set(self, key, version, value, timeout=None):
+        """Cache value for key, built from version, for self.timeout seconds or timeout if that is shorter"""
+        now = time.time()
+        if timeout is None or timeout > self.timeout:
+            timeout = self.timeout
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (version, value, now + timeout, now)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+
+_local_cache = None
+
+
+def get_local_cache():
+    """Return the process-wide LocalCache configured by BASIC_MODELS_LOCAL_CACHE, or None when it is disabled"""
+    global _local_cache
+    options = getattr(settings, 'BASIC_MODELS_LOCAL_CACHE', None)
+    if not options:
+        return None
+    if _local_cache is None:
+        _local_cache = LocalCache(
+            max_entries=options.get('MAX_ENTRIES', 100),
+            timeout=options.get('TIMEOUT', 300),
+            grace=options.get('GRACE', 1.0),
+        )
+    return _local_cache
+
+
+def _reset_local_cache(setting, **kwargs):
+    global _local_cache
+    if setting == 'BASIC_MODELS_LOCAL_CACHE':
+        _local_cache = None
+
+setting_changed.connect(_reset_local_cache)
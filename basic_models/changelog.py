@@ -0,0 +1,70 @@
+# Copyright 2011 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Buffered writes for the change log of models with change_log = True.
+
+Entries recorded inside a transaction are held until it commits and then
+written with one bulk INSERT per BASIC_MODELS_CHANGE_LOG_BATCH_SIZE entries;
+a rollback drops them (Django >= 1.9). Inside batch_changes() they are held
+until the outermost block exits. Otherwise they are written right away.
+"""
+
+import json
+import time
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.encoding import force_text
+
+from basic_models.caching import BufferedWrites
+from basic_models.instrumentation import get_collector
+
+
+class _ChangeEncoder(DjangoJSONEncoder):
+    def default(self, o):
+        try:
+            return super(_ChangeEncoder, self).default(o)
+        except TypeError:
+            return force_text(o)
+
+
+def encode_changes(changes):
+    """Serialize a {attname: [old, new]} dict as compact JSON"""
+    return json.dumps(changes, cls=_ChangeEncoder, separators=(',', ':'), sort_keys=True)
+
+
+def write_changes(entries, using=None):
+    from basic_models.models import ChangeLogEntry
+
+    batch_size = getattr(settings, 'BASIC_MODELS_CHANGE_LOG_BATCH_SIZE', 500)
+    start = time.time()
+    ChangeLogEntry.objects.db_manager(using or DEFAULT_DB_ALIAS).bulk_create(entries, batch_size=batch_size)
+    collector = get_collector()
+    if collector is not None:
+        collector.incr('change_log.entries', len(entries))
+        collector.timing('change_log.write', time.time() - start)
+
+
+_changes = BufferedWrites('change_log', list, write_changes)
+
+
+def record_changes(entries, using=None):
+    """Save entries, a list of unsaved ChangeLogEntry instances, as described above"""
+    _changes.add(entries, using)
+
+
+def batch_changes():
+    """Coalesce every entry recorded inside the block into bulk INSERTs"""
+    return _changes.batch()
@@ -0,0 +1,107 @@
+# Copyright 2011 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, transaction
+from django.db.backends.utils import truncate_name
+from django.db.models.signals import post_migrate
+
+logger = logging.getLogger(__name__)
+
+
+class RawIndex(object):
+    """An index created with raw DDL after migrate, for what Meta can't declare.
+
+    When `where` names a boolean field the index only covers the rows where it
+    is true; partial indexes are only created on the backends that support them
+    (PostgreSQL and SQLite >= 3.8).
+    """
+
+    def __init__(self, fields, where=None, unique=False, name=None):
+        self.fields = list(fields)
+        self.where = where
+        self.unique = unique
+        self.name = name
+
+    def get_name(self, model, connection):
+        name = self.name or '%s_%s_%s' % (
+            model._meta.db_table, '_'.join(self.fields),
+            'uniq' if self.unique else 'part' if self.where else 'idx')
+        return truncate_name(name, connection.ops.max_name_length())
+
+    def create_sql(self, model, connection):
+        qn = connection.ops.quote_name
+        columns = [model._meta.get_field(field).column for field in self.fields]
+        sql = 'CREATE %sINDEX %s ON %s (%s)' % (
+            'UNIQUE ' if self.unique else '',
+            qn(self.get_name(model, connection)),
+            qn(model._meta.db_table),
+            ', '.join(qn(column) for column in columns),
+        )
+        if self.where:
+            sql += ' WHERE %s' % qn(model._meta.get_field(self.where).column)
+        return sql
+
+
+def default_indexes_enabled(model):
+    """Whether model wants the indexes the abstract models declare for the queries basic_models runs.
+
+    They are created with raw DDL outside of migrations, so they are off unless
+    BASIC_MODELS_DEFAULT_INDEXES is set; default_indexes = False opts a model out.
+    """
+    return getattr(model, 'default_indexes', True) and getattr(settings, 'BASIC_MODELS_DEFAULT_INDEXES', False)
+
+
+def supports_partial_indexes(connection):
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        from django.db.backends.sqlite3.base import Database
+        return Database.sqlite_version_info >= (3, 8, 0)
+    return False
+
+
+def create_raw_indexes(model, using=DEFAULT_DB_ALIAS):
+    """Create any missing indexes declared by model.get_raw_indexes()"""
+    connection = connections[using]
+    indexes = getattr(model, 'get_raw_indexes', lambda: [])()
+    if not supports_partial_indexes(connection):
+        indexes = [index for index in indexes if not index.where]
+    if not indexes:
+        return
+    with connection.cursor() as cursor:
+        if model._meta.db_table not in connection.introspection.table_names(cursor):
+            return
+        existing = set(connection.introspection.get_constraints(cursor, model._meta.db_table))
+        for index in indexes:
+            if index.get_name(model, connection) in existing:
+                continue
+            existing.add(index.get_name(model, connection))
+            try:
+                with transaction.atomic(using=using):
+                    cursor.execute(index.create_sql(model, connection))
+            except DatabaseError as e:
+                # most likely existing rows violate a unique index; the table still works without it
+                logger.warning("Could not create index %s on %s: %s",
+                               index.get_name(model, connection), model._meta.db_table, e)
+
+
+def create_raw_indexes_for_app(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    for model in sender.get_models():
+        if model._meta.managed and not model._meta.proxy and not model._meta.swapped:
+            create_raw_indexes(model, using)
+
+post_migrate.connect(create_raw_indexes_for_app, dispatch_uid='basic_models_raw_indexes')
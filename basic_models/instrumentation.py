@@ -0,0 +1,145 @@
+# Copyright 2011 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Counters and timings for the cache and bulk paths, off unless BASIC_MODELS_METRICS is set.
+
+BASIC_MODELS_METRICS is True for the in-process MemoryCollector, or a
+collector instance or dotted path to a collector class. A collector has two
+methods:
+
+    incr(name, value=1, model=None)
+    timing(name, seconds, model=None)
+
+where model is an 'app_label.model_name' label. Call sites fetch the collector
+with get_collector() and skip all bookkeeping when it returns None.
+"""
+
+import bisect
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
+
+try:
+    string_types = basestring
+except NameError:
+    # Python 3
+    string_types = str
+
+
+_UNSET = object()
+_collector = _UNSET
+
+
+def get_collector():
+    """Return the configured collector, or None when instrumentation is off"""
+    global _collector
+    if _collector is _UNSET:
+        _collector = _load_collector()
+    return _collector
+
+
+def _load_collector():
+    option = getattr(settings, 'BASIC_MODELS_METRICS', None)
+    if not option:
+        return None
+    if option is True:
+        return MemoryCollector()
+    if isinstance(option, string_types):
+        return import_string(option)()
+    return option
+
+
+def _reset_collector(setting, **kwargs):
+    global _collector
+    if setting == 'BASIC_MODELS_METRICS':
+        _collector = _UNSET
+
+setting_changed.connect(_reset_collector)
+
+
+def model_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.model_name)
+
+
+class Lookup(object):
+    """Reports one read-through cache lookup as a hit, or as a miss when its rebuild runs, timing the rebuild.
+
+    Pass lookup.rebuild where the rebuild function would go, then call done().
+    """
+
+    def __init__(self, collector, name, model, rebuild):
+        self.collector = collector
+        self.name = name
+        self.model = model
+        self.missed = False
+        self._rebuild = rebuild
+
+    def rebuild(self, *args, **kwargs):
+        self.missed = True
+        start = time.time()
+        try:
+            return self._rebuild(*args, **kwargs)
+        finally:
+            self.collector.timing('%s.rebuild' % self.name, time.time() - start, self.model)
+
+    def done(self):
+        self.collector.incr('%s.%s' % (self.name, 'miss' if self.missed else 'hit'), model=self.model)
+
+
+class MemoryCollector(object):
+    """Keeps counters and timing histograms in process memory; read them with snapshot()"""
+
+    # upper bounds, in seconds, of the histogram buckets; the last bucket is unbounded
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters = defaultdict(int)
+            self._timings = {}
+
+    def incr(self, name, value=1, model=None):
+        with self._lock:
+            self._counters[(name, model)] += value
+
+    def timing(self, name, seconds, model=None):
+        with self._lock:
+            histogram = self._timings.get((name, model))
+            if histogram is None:
+                histogram = self._timings[(name, model)] = {
+                    'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * (len(self.buckets) + 1)}
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            histogram['max'] = max(histogram['max'], seconds)
+            histogram['buckets'][bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def counter(self, name, model=None):
+        return self._counters.get((name, model), 0)
+
+    def snapshot(self):
+        """Return {'counters': {key: value}, 'timings': {key: histogram}}, keyed by 'name' or 'name:model'"""
+        def key(name, model):
+            return name if model is None else '%s:%s' % (name, model)
+        with self._lock:
+            return {
+                'counters': dict((key(*k), v) for k, v in self._counters.items()),
+                'timings': dict((key(*k), dict(v, buckets=list(v['buckets']))) for k, v in self._timings.items()),
+            }
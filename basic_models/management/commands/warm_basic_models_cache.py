@@ -0,0 +1,54 @@
+# Copyright 2011 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from basic_models.warming import warm_caches, warmable_models
+
+
+class Command(BaseCommand):
+    help = "Prefill the get_active() and slug/pk cache entries of OnlyOneActiveModels and SlugModels."
+
+    def add_arguments(self, parser):
+        parser.add_argument('labels', nargs='*', metavar='app_label[.ModelName]',
+                            help="only warm these apps or models")
+        parser.add_argument('--chunk-size', type=int, default=500, help="rows read and published at a time")
+        parser.add_argument('--workers', type=int, default=1, help="warm this many models in parallel")
+        parser.add_argument('--all', action='store_false', dest='active_only',
+                            help="publish inactive rows too")
+
+    def handle(self, *args, **options):
+        models = warmable_models()
+        if options['labels']:
+            models = [model for model in models if self._selected(model, options['labels'])]
+            if not models:
+                raise CommandError("No OnlyOneActiveModel or SlugModel matches %s" % ", ".join(options['labels']))
+
+        start = time.time()
+        counts = warm_caches(models, chunk_size=options['chunk_size'], workers=options['workers'],
+                             active_only=options['active_only'])
+        for label in sorted(counts):
+            self.stdout.write("%s: %d rows published" % (label, counts[label]))
+        self.stdout.write("Warmed %d models in %.2f seconds." % (len(models), time.time() - start))
+
+    def _selected(self, model, labels):
+        for label in labels:
+            app_label, _, model_name = label.partition('.')
+            if app_label != model._meta.app_label:
+                continue
+            if not model_name or model_name.lower() == model._meta.model_name:
+                return True
+        return False
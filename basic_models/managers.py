@@ -12,38 +12,425 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
+import calendar
+import datetime
+import hashlib
+import json
+import re
+import time
+from collections import OrderedDict
+
+from django.apps import apps
 from django.core.cache import cache
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models.query import QuerySet
-from django.db import models
+from django.db import DEFAULT_DB_ALIAS, connections, models, transaction
+from django.db.models import Min, Prefetch, Q
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.db.models.sql import DeleteQuery
+from django.utils import timezone
+from django.utils.encoding import force_text
+from autoslug import AutoSlugField
+from autoslug import utils as autoslug_utils
+
+from basic_models.caching import (MISSING, bump_version, get_local_cache, get_or_rebuild_entry, get_versions,
+                                  on_commit, publish_items, refresh_time, unpublish_keys)
+from basic_models.instrumentation import Lookup, get_collector, model_label
+from cachemodel.utils import generate_cache_key
+
+try:
+    from basic_models.aio import AsyncActiveQuerySetMixin, AsyncOnlyOneActiveManagerMixin, AsyncSlugModelManagerMixin
+except (ImportError, SyntaxError):
+    # Python 2, or no asgiref: no async methods
+    AsyncActiveQuerySetMixin = AsyncOnlyOneActiveManagerMixin = AsyncSlugModelManagerMixin = object
 
 
 class CustomQuerySetManager(models.Manager):
+    """Manager that exposes the public methods of a custom QuerySet class.
+
+    Build subclasses with CustomQuerySetManager.from_queryset(SomeQuerySet) so the
+    proxy methods are generated once, when the class is created. Passing
+    query_set to the constructor still works; methods the class doesn't
+    already proxy are then looked up on a fresh queryset on each access.
+    """
     def __init__(self, query_set=None):
-        self._custom_query_set = query_set
         super(CustomQuerySetManager, self).__init__()
-
-    def get_queryset(self):
-        if self._custom_query_set:
-            return self._custom_query_set(self.model)
-        return QuerySet(self.model)
+        if query_set is not None:
+            self._queryset_class = query_set
 
     def __getattr__(self, attr, *args):
-        if attr.startswith('_'):
+        # only reached for attributes the class doesn't define
+        queryset_class = self.__dict__.get('_queryset_class')
+        if attr.startswith('_') or queryset_class is None or not hasattr(queryset_class, attr):
             # Helps avoid problems when pickling a model.
-            raise AttributeError
-        # expose queryset methods as manager methods as well.
+            raise AttributeError(attr)
         return getattr(self.get_queryset(), attr, *args)
 
 
-class ActiveQuerySet(QuerySet):
+def _auto_now_updates(model):
+    """The auto_now values save() would stamp, for UPDATEs that bypass it on models with stamp_bulk_updates"""
+    if not getattr(model, 'stamp_bulk_updates', False):
+        return {}
+    now = timezone.now()
+    return dict((field.name, now) for field in model._meta.concrete_fields if getattr(field, 'auto_now', False))
+
+
+class Chunk(list):
+    """A list of rows from iter_chunks(), with the token that resumes iteration after its last row"""
+    def __init__(self, rows, token):
+        super(Chunk, self).__init__(rows)
+        self.token = token
+
+
+class ActiveQuerySet(QuerySet, AsyncActiveQuerySetMixin):
     def active(self):
         return self.filter(is_active=True)
 
+    def update(self, **kwargs):
+        # stamp updated_at like save() would, so changed_since() sees bulk updates too
+        # (only on models with stamp_bulk_updates)
+        for name, value in _auto_now_updates(self.model).items():
+            kwargs.setdefault(name, value)
+        rows = None
+        if getattr(self.model, 'published_keys', None) is not None:
+            rows = list(self.order_by().values(*self.model.cache_lookup_fields()))
+        return self._update_published(rows, **kwargs)
+    update.alters_data = True
+
+    def _update_published(self, rows, **kwargs):
+        # update() for callers that hold the rows' cache_lookup_fields() values
+        # already; the keys they were published under are dropped, since the
+        # cached copies (and get_by_natural_key()) would otherwise stay stale
+        count = super(ActiveQuerySet, self).update(**kwargs)
+        if rows:
+            unpublish_keys(self.model.published_keys(rows), self.db)
+        # bulk updates send no signals
+        invalidate_dependents(self.model, self.db)
+        return count
+    _update_published.alters_data = True
+
+    def changed_since(self, watermark, overlap=None):
+        """Rows changed after watermark, in (updated_at, pk) order.
+
+        watermark is a datetime, a token from iter_chunks(key='updated_at') or
+        None for every row. Walk the result with iter_chunks(key='updated_at')
+        and keep the last chunk's token as the next watermark.
+
+        updated_at is stamped before the transaction commits, so a row whose
+        transaction commits after the watermark has passed its stamp is never
+        returned. overlap, a timedelta longer than such transactions, also
+        returns the rows changed that long before the watermark; rows may then
+        be returned more than once.
+        """
+        queryset = self.order_by('updated_at', 'pk')
+        if watermark is None:
+            return queryset
+        if not isinstance(watermark, datetime.datetime):
+            key_fields = ['updated_at', 'pk']
+            last = self._decode_chunk_token(watermark, key_fields)
+            if not overlap:
+                return queryset.filter(self._after_keyset(key_fields, last))
+            watermark = last[0]
+        if overlap:
+            watermark -= overlap
+        return queryset.filter(updated_at__gt=watermark)
+
+    def iter_chunks(self, size=1000, fields=None, key='pk', token=None):
+        """Yield the rows of this queryset as Chunks of at most `size` rows.
+
+        Rows are paged by keyset rather than OFFSET, one short query per chunk,
+        so memory stays bounded and no cursor stays open between chunks. `key`
+        is 'pk', or 'updated_at' to walk rows in (updated_at, pk) order. With
+        `fields` the chunks hold values_list() tuples instead of instances.
+        Pass a chunk's token back in as `token` to resume after that chunk.
+        """
+        assert self.query.can_filter(), "Cannot iterate a sliced queryset in chunks."
+        key_fields = ['updated_at', 'pk'] if key == 'updated_at' else ['pk']
+        queryset = self.order_by(*key_fields)
+        extra = []
+        if fields is not None:
+            fields = list(fields)
+            extra = [name for name in key_fields if name not in fields]
+            queryset = queryset.values_list(*(fields + extra))
+            positions = [(fields + extra).index(name) for name in key_fields]
+
+        last = self._decode_chunk_token(token, key_fields) if token else None
+        while True:
+            page = queryset
+            if last is not None:
+                page = page.filter(self._after_keyset(key_fields, last))
+            rows = list(page[:size])
+            if not rows:
+                return
+            if fields is None:
+                last = [getattr(rows[-1], name) for name in key_fields]
+            else:
+                last = [rows[-1][position] for position in positions]
+                if extra:
+                    rows = [row[:len(fields)] for row in rows]
+            yield Chunk(rows, self._encode_chunk_token(key_fields, last))
+            if len(rows) < size:
+                return
+
+    def iter_active_chunks(self, *args, **kwargs):
+        """iter_chunks() over the active rows"""
+        return self.active().iter_chunks(*args, **kwargs)
+
+    @staticmethod
+    def _after_keyset(key_fields, values):
+        # (a, b) > (x, y) spelled out as a > x OR (a = x AND b > y)
+        condition = Q(**{'%s__gt' % key_fields[-1]: values[-1]})
+        for name, value in reversed(list(zip(key_fields[:-1], values[:-1]))):
+            condition = Q(**{'%s__gt' % name: value}) | (Q(**{name: value}) & condition)
+        return condition
+
+    @staticmethod
+    def _encode_chunk_token(key_fields, values):
+        data = json.dumps([key_fields, values], cls=_ChunkTokenEncoder)
+        return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+    def _decode_chunk_token(self, token, key_fields):
+        names, values = json.loads(base64.urlsafe_b64decode(str(token)).decode('utf-8'))
+        if names != key_fields:
+            raise ValueError("The token was made for a %s keyset, not %s." % (names, key_fields))
+        opts = self.model._meta
+        return [(opts.pk if name == 'pk' else opts.get_field(name)).to_python(value)
+                for name, value in zip(names, values)]
+
+    def delete(self):
+        # deleting in bulk bypasses Model.delete(), which drops the published cache entries
+        published_keys = getattr(self.model, 'published_keys', None)
+        if published_keys is not None:
+            rows = list(self.order_by().values(*self.model.cache_lookup_fields()))
+        result = super(ActiveQuerySet, self).delete()
+        if published_keys is not None:
+            unpublish_keys(published_keys(rows), self.db)
+        invalidate_dependents(self.model, self.db)
+        return result
+    delete.alters_data = True
+
+    def publish(self, batch_size=500):
+        """Publish every row to the cache, batch_size instances per set_many()"""
+        batch = []
+        for instance in self.iterator():
+            batch.append(instance)
+            if len(batch) >= batch_size:
+                self.model.publish_many(batch)
+                batch = []
+        self.model.publish_many(batch)
+
+
+    def archive(self, older_than=None, batch_size=500):
+        """Move the inactive rows of this queryset that haven't changed for older_than to the archive table.
+
+        older_than defaults to the model's archive_after. Rows are moved
+        batch_size at a time, each batch with one INSERT ... SELECT and one
+        DELETE in its own transaction. Rows that other rows still point at are
+        left in place. Returns the number of rows moved.
+        """
+        archive_model = _archive_model(self.model)
+        if older_than is None:
+            older_than = self.model.archive_after
+        candidates = _unreferenced(self.filter(is_active=False, updated_at__lt=timezone.now() - older_than))
+        candidates = candidates.order_by('pk').values(*self.model.cache_lookup_fields())
+        moved = 0
+        while True:
+            with transaction.atomic(using=self.db):
+                rows = list(candidates[:batch_size])
+                if not rows:
+                    break
+                # lock the rows, and skip any that were activated since
+                locked = self.model._base_manager.using(self.db).filter(
+                    pk__in=[row['pk'] for row in rows], is_active=False)
+                if connections[self.db].features.has_select_for_update:
+                    locked = locked.select_for_update()
+                pks = set(locked.values_list('pk', flat=True))
+                rows = [row for row in rows if row['pk'] in pks]
+                _move_rows(self.model, archive_model, list(pks), self.db)
+            unpublish_keys(self.model.published_keys(rows), self.db)
+            moved += len(rows)
+        if moved:
+            self._rows_moved()
+        return moved
+    archive.alters_data = True
+
+    def restore_archived(self, pks, batch_size=500):
+        """Move the archived rows with the given primary keys back into the table; returns the number moved.
+
+        The archive doesn't enforce unique fields, and live rows may have taken
+        an archived row's values since. An archived row whose AutoSlugField slug
+        is taken gets a new slug, picked the way AutoSlugField would; a row
+        whose other unique values are taken stays in the archive.
+        """
+        archive_model = _archive_model(self.model)
+        pks = list(pks)
+        restored = 0
+        for i in range(0, len(pks), batch_size):
+            with transaction.atomic(using=self.db):
+                archived = archive_model._base_manager.using(self.db).filter(pk__in=pks[i:i + batch_size])
+                found = _restorable(self.model, archived, self.db)
+                _move_rows(archive_model, self.model, found, self.db)
+            restored += len(found)
+        if restored:
+            self._rows_moved()
+        return restored
+    restore_archived.alters_data = True
+
+    def _rows_moved(self):
+        invalidate_dependents(self.model, self.db)
+
+
+class _ChunkTokenEncoder(DjangoJSONEncoder):
+    # UUIDs, Decimals and dates as strings the key field's to_python() reads back
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            # DjangoJSONEncoder drops the microseconds the keyset needs
+            return o.isoformat()
+        return super(_ChunkTokenEncoder, self).default(o)
+
 
-class ActiveModelManager(CustomQuerySetManager):
-    def __init__(self):
-        super(ActiveModelManager, self).__init__(query_set=ActiveQuerySet)
+def _archive_model(model):
+    if model._archive_model is None:
+        raise TypeError("%s has no archive_after, so it has no archive table." % model.__name__)
+    return model._archive_model
+
+
+def _assign_slugs(queryset, field, objs, reserved=()):
+    # set the AutoSlugField field of objs to slugs unique against queryset,
+    # reserved and each other, the way AutoSlugField.pre_save() picks them
+    by_base = OrderedDict()
+    for obj in objs:
+        value = getattr(obj, field.attname) or autoslug_utils.get_prepopulated_value(field, obj)
+        slug = autoslug_utils.crop_slug(field, field.slugify(value)) if value else ''
+        by_base.setdefault(slug, []).append(obj)
+
+    bases = [base for base in by_base if base]
+    existing = set()
+    for i in range(0, len(bases), 500):
+        existing.update(queryset.filter(**{'%s__in' % field.attname: bases[i:i + 500]}).values_list(
+            field.attname, flat=True))
+
+    assigned = set(reserved)
+    taken = {}
+    for base, group in by_base.items():
+        index = 1
+        for obj in group:
+            slug = base
+            if base and (base in existing or base in assigned):
+                while True:
+                    index += 1
+                    tail = '%s%d' % (field.index_sep, index)
+                    # a long base is cut short to make room for the tail, and the
+                    # slugs it could clash with then start with the shorter prefix
+                    prefix = base[:field.max_length - len(tail)]
+                    slug = prefix + tail
+                    if prefix not in taken:
+                        taken[prefix] = set(queryset.filter(**{'%s__startswith' % field.attname: prefix}).values_list(
+                            field.attname, flat=True))
+                    if slug not in taken[prefix] and slug not in assigned:
+                        break
+            assigned.add(slug)
+            setattr(obj, field.attname, slug)
+
+
+def _restorable(model, archived, using):
+    # the pks of the archived rows that can go back without breaking a unique
+    # field, re-slugging the rows that clash on an AutoSlugField
+    live = model._base_manager.using(using)
+    pks = set(archived.values_list('pk', flat=True))
+    for field in model._meta.concrete_fields:
+        if not field.unique or field.primary_key:
+            continue
+        values = sorted(archived.filter(pk__in=pks).exclude(**{'%s__isnull' % field.attname: True}).values_list(
+            'pk', field.attname))
+        taken = set(live.filter(**{'%s__in' % field.attname: [value for pk, value in values]}).values_list(
+            field.attname, flat=True))
+        clashes = []
+        kept = set()
+        for pk, value in values:
+            # archived rows can also share a value among themselves
+            if value in taken or value in kept:
+                clashes.append(pk)
+            else:
+                kept.add(value)
+        if not clashes:
+            continue
+        if isinstance(field, AutoSlugField) and not field.unique_with:
+            rows = list(archived.filter(pk__in=clashes))
+            for row in rows:
+                setattr(row, field.attname, '')
+            _assign_slugs(live, field, rows, kept)
+            for row in rows:
+                archived.filter(pk=row.pk).update(**{field.attname: getattr(row, field.attname)})
+        else:
+            pks.difference_update(clashes)
+    return list(pks)
+
+
+def _unreferenced(queryset):
+    # the rows no foreign key or many-to-many link points at
+    for relation in queryset.model._meta.get_fields():
+        if relation.is_relation and (relation.many_to_many or relation.auto_created) and not relation.concrete:
+            queryset = queryset.filter(**{'%s__isnull' % relation.name: True})
+    return queryset
+
+
+def _move_rows(source, target, pks, using):
+    # copy the rows over with one INSERT ... SELECT, then delete them
+    if not pks:
+        return
+    connection = connections[using]
+    fields = source._meta.concrete_fields
+    select, params = source._base_manager.using(using).filter(pk__in=pks).order_by().values_list(
+        *[field.attname for field in fields]).query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('INSERT INTO %s (%s) %s' % (
+            connection.ops.quote_name(target._meta.db_table),
+            ', '.join(connection.ops.quote_name(field.column) for field in fields),
+            select), params)
+    DeleteQuery(source).delete_batch(pks, using)
+
+
+class ArchiveManagerMixin(object):
+    """Reads across the table and the archive table of models with archive_after"""
+
+    def archived(self):
+        """Return a queryset of the archived rows, as instances of the archive model"""
+        return _archive_model(self.model)._base_manager.using(self.db).all()
+
+    def with_archived(self, *args, **kwargs):
+        """Yield the rows matching the filters from the table, then those from the archive.
+
+        Archived rows come as instances of this model with _archived set; they
+        are for reading, restore them with restore_archived() to change them.
+        """
+        for instance in self.filter(*args, **kwargs).iterator():
+            yield instance
+        for archived in self.archived().filter(*args, **kwargs).iterator():
+            yield self._from_archive(archived)
+
+    def get_with_archived(self, *args, **kwargs):
+        """get() that falls back to the archive"""
+        try:
+            return self.get(*args, **kwargs)
+        except self.model.DoesNotExist:
+            try:
+                return self._from_archive(self.archived().get(*args, **kwargs))
+            except _archive_model(self.model).DoesNotExist:
+                raise self.model.DoesNotExist("%s matching query does not exist." % self.model._meta.object_name)
+
+    def _from_archive(self, archived):
+        attnames = [field.attname for field in self.model._meta.concrete_fields]
+        instance = self.model.from_db(self.db, attnames, [getattr(archived, attname) for attname in attnames])
+        instance._archived = True
+        return instance
+
+
+class ActiveModelManager(CustomQuerySetManager.from_queryset(ActiveQuerySet), ArchiveManagerMixin):
+    pass
 
 
 class FilteredActiveObjectsManager(ActiveModelManager):
@@ -55,22 +442,466 @@ class DefaultModelManager(ActiveModelManager):
     pass
 
 
-class SlugModelManager(DefaultModelManager):
+class SlugModelManager(DefaultModelManager, AsyncSlugModelManagerMixin):
     def get_by_natural_key(self, slug):
-        return self.get(slug=slug)
+        """Read through the cache entry SlugModel.publish() keeps under the slug"""
+        if not self._uses_published_cache():
+            return self.get(slug=slug)
+        collector = get_collector()
+        instance = cache.get(self._slug_key(slug))
+        if instance is None or instance.slug != slug:
+            start = time.time()
+            instance = self.get(slug=slug)
+            if collector is not None:
+                collector.incr('natural_key.miss', model=model_label(self.model))
+                collector.timing('natural_key.query', time.time() - start, model_label(self.model))
+            items = instance.split_field_items()
+            items[self._slug_key(slug)] = instance
+            publish_items(items, self.db)
+        elif collector is not None:
+            collector.incr('natural_key.hit', model=model_label(self.model))
+        return instance
 
+    def get_many_by_natural_keys(self, slugs, batch_size=500):
+        """Return a {slug: instance} dict for those of slugs that exist, reading through the cache"""
+        slugs = set(slugs)
+        found = {}
+        if self._uses_published_cache():
+            keys = dict((self._slug_key(slug), slug) for slug in slugs)
+            for key, instance in cache.get_many(list(keys)).items():
+                if instance.slug == keys[key]:
+                    found[instance.slug] = instance
 
-class OnlyOneActiveManager(models.Manager):
-    def get_active(self):
-        cache_key = 'active_%s' % (self.model.__name__)
-        active = cache.get(cache_key)
-        if active is None:
-            active = self.filter(is_active=True).order_by('-updated_at')
-            if len(active) < 1:
-                # no active one!... just pick the last one that was changed
-                active = self.all().order_by('-updated_at')
-                if len(active) < 1:
-                    return None
-            active = active[0]
-            cache.set(cache_key, active, getattr(settings, "DEFAULT_CACHE_TIMEOUT", 900))
+        missing = [slug for slug in slugs if slug not in found]
+        collector = get_collector()
+        if collector is not None:
+            collector.incr('natural_key.hit', len(found), model_label(self.model))
+            collector.incr('natural_key.miss', len(missing), model_label(self.model))
+        fetched = {}
+        start = time.time()
+        for i in range(0, len(missing), batch_size):
+            for instance in self.filter(slug__in=missing[i:i + batch_size]):
+                fetched[self._slug_key(instance.slug)] = found[instance.slug] = instance
+                fetched.update(instance.split_field_items())
+        if collector is not None and missing:
+            collector.timing('natural_key.query', time.time() - start, model_label(self.model))
+        if self._uses_published_cache():
+            publish_items(fetched, self.db)
+        return found
+
+    def bulk_create_with_slugs(self, objs, batch_size=None):
+        """bulk_create() for SlugModels, assigning unique slugs in memory.
+
+        Slugs are generated the way AutoSlugField does it, but rather than
+        probing the database once per candidate and row, the base slugs are
+        checked with one slug__in query per batch_size bases, and one prefix
+        query is run for each base that needs a numeric suffix. The primary
+        keys are then read back through the unique slugs, one query per 500
+        rows; if the slug field isn't unique, objs are left without them, as
+        bulk_create() leaves them on most backends.
+        """
+        objs = list(objs)
+        field = self.model._meta.get_field('slug')
+        if field.unique_with or self.model._meta.parents:
+            # slugs unique per other fields, and multi-table rows, go through save()
+            for obj in objs:
+                obj.save(force_insert=True, using=self.db)
+            return objs
+        if not objs:
+            return objs
+
+        with transaction.atomic(using=self.db):
+            _assign_slugs(self.model._base_manager.using(self.db), field, objs)
+            self._insert_presluged(objs, field, batch_size)
+        return objs
+
+    def _insert_presluged(self, objs, slug_field, batch_size):
+        # bulk_create() would run AutoSlugField.pre_save(), which queries for
+        # rivals once per row; insert raw instead, running the other fields'
+        # pre_save() (auto_now and friends) by hand
+        connection = connections[self.db]
+        fields = [f for f in self.model._meta.local_concrete_fields if not isinstance(f, models.AutoField)]
+        for obj in objs:
+            for f in fields:
+                if f is not slug_field:
+                    setattr(obj, f.attname, f.pre_save(obj, True))
+        batch_size = min(batch_size or len(objs), connection.ops.bulk_batch_size(fields, objs)) or 1
+        queryset = self.model._base_manager.using(self.db)
+        for i in range(0, len(objs), batch_size):
+            queryset._insert(objs[i:i + batch_size], fields=fields, using=self.db, raw=True)
+        if not slug_field.unique:
+            return
+        # most backends can't return the new ids from a bulk insert
+        slugs = [getattr(obj, slug_field.attname) for obj in objs]
+        pks = {}
+        for i in range(0, len(slugs), 500):
+            pks.update(queryset.filter(**{'%s__in' % slug_field.attname: slugs[i:i + 500]}).values_list(
+                slug_field.attname, 'pk'))
+        for obj in objs:
+            obj.pk = pks[getattr(obj, slug_field.attname)]
+            obj._state.adding = False
+            obj._state.db = self.db
+
+    def _slug_key(self, slug):
+        return generate_cache_key([self.model.__name__, "get"], slug=slug)
+
+    def _uses_published_cache(self):
+        # published entries are only kept for the default database
+        return self._db in (None, DEFAULT_DB_ALIAS)
+
+
+class ChangeLogManager(models.Manager):
+    def for_object(self, obj):
+        """Return the change log of obj, oldest first, read through the (content_type, object_id, timestamp) index"""
+        from django.contrib.contenttypes.models import ContentType
+        content_type = ContentType.objects.db_manager(self.db).get_for_model(obj.__class__)
+        return self.filter(content_type=content_type, object_id=force_text(obj.pk)).order_by('timestamp', 'pk')
+
+
+class WatermarkManager(models.Manager):
+    def get_token(self, name):
+        """Return the token saved under name, or None"""
+        return self.filter(name=name).values_list('token', flat=True).first()
+
+    def save_token(self, name, token):
+        if not self.filter(name=name).update(token=token):
+            self.create(name=name, token=token)
+
+    def iter_changes(self, name, queryset, size=1000, overlap=None):
+        """Yield chunks of the rows of queryset changed since the watermark saved under name.
+
+        The watermark moves past a chunk once the caller asks for the next one,
+        so a job that dies part way resumes with the chunk it was processing.
+        overlap is passed on to changed_since().
+        """
+        chunks = queryset.changed_since(self.get_token(name), overlap).iter_chunks(size, key='updated_at')
+        for chunk in chunks:
+            yield chunk
+            self.save_token(name, chunk.token)
+
+
+def _timestamp(value):
+    # a datetime as a time.time() value
+    if timezone.is_aware(value):
+        return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+    return time.mktime(value.timetuple()) + value.microsecond / 1e6
+
+
+def _active_namespace(model, using, scope=()):
+    namespace = '%s.%s:%s' % (model._meta.app_label, model._meta.model_name, using)
+    if scope:
+        namespace += ':' + ','.join('%s=%s' % (attname, _scope_key(value)) for attname, value in scope)
+    return namespace
+
+
+def _scope_key(value):
+    # scope values end up in cache keys, so anything but plain words is hashed
+    value = force_text(value)
+    if _plain_scope_value.match(value):
+        return value
+    return hashlib.md5(value.encode('utf-8')).hexdigest()[:12]
+
+_plain_scope_value = re.compile(r'^[\w.-]{1,64}$')
+
+
+def active_scope_items(model, values):
+    """Turn get_active() keyword arguments into the ((attname, value), ...) scope of model.
+
+    Each field named in model.active_scope may be given by name or attname, as
+    an instance or a primary key.
+    """
+    values = dict(values)
+    items = []
+    for name in getattr(model, 'active_scope', ()):
+        field = model._meta.get_field(name)
+        if field.name in values:
+            value = values.pop(field.name)
+        elif field.attname in values:
+            value = values.pop(field.attname)
+        else:
+            raise TypeError("%s is scoped by %s; pass %s= to look up its active row." % (
+                model.__name__, ', '.join(model.active_scope), field.name))
+        if isinstance(value, models.Model):
+            value = value.pk
+        items.append((field.attname, value))
+    if values:
+        raise TypeError("%s has no active scope called %s." % (model.__name__, ', '.join(sorted(values))))
+    return tuple(items)
+
+
+def invalidate_active(model, using, scope=None):
+    """Orphan the cached get_active() results for model on the given database.
+
+    scope is a ((attname, value), ...) tuple from active_scope_items(); None
+    orphans the results of every scope.
+    """
+    namespace = _active_namespace(model, using, scope or ())
+    bump_version('basic_models:active_version:%s' % namespace)
+    local = get_local_cache()
+    if local is not None:
+        # other processes notice the new version once their grace window ends
+        local.delete(namespace)
+        local.delete_prefix(namespace + '|')
+        if not scope:
+            local.delete_prefix(namespace + ':')
+
+
+def _prefetch_digest(lookups):
+    # a short, stable name for a list of prefetch_related() lookups
+    parts = []
+    for lookup in lookups:
+        if isinstance(lookup, Prefetch):
+            parts.append('%s=%s' % (lookup.prefetch_to, lookup.queryset.query if lookup.queryset is not None else ''))
+        else:
+            parts.append(lookup)
+    return hashlib.md5(u'\n'.join(parts).encode('utf-8')).hexdigest()[:12]
+
+
+_prefetch_dependents = {}
+_registered_prefetches = set()
+
+
+def _register_prefetch(model, lookups):
+    """Invalidate model's get_active() entries whenever rows the lookups prefetch change"""
+    key = (model, _prefetch_digest(lookups))
+    if key in _registered_prefetches:
+        return
+    for related in _prefetched_models(model, lookups):
+        if related not in _prefetch_dependents:
+            # connected per sender: a post_delete receiver for every model would
+            # stop Django from deleting querysets without loading them
+            for signal in (post_save, post_delete, m2m_changed):
+                signal.connect(_related_changed, sender=related, dispatch_uid='basic_models_prefetch')
+        _prefetch_dependents.setdefault(related, set()).add(model)
+    _registered_prefetches.add(key)
+
+
+def register_declared_prefetches():
+    """Register the active_prefetch lookups of every model, so writers invalidate entries they never read"""
+    for model in apps.get_models():
+        if getattr(model, 'active_prefetch', None):
+            _register_prefetch(model, model.active_prefetch)
+
+
+def _prefetched_models(model, lookups):
+    # every model, many-to-many through tables included, along the lookup paths
+    models = set()
+    for lookup in lookups:
+        current = model
+        for name in getattr(lookup, 'prefetch_through', lookup).split(LOOKUP_SEP):
+            relation = _relation(current, name)
+            if relation.many_to_many:
+                field = relation.field if relation.auto_created else relation
+                models.add(_remote_field(field).through._meta.concrete_model)
+            current = relation.related_model
+            models.add(current._meta.concrete_model)
+    return models
+
+
+def _relation(model, name):
+    # the relation a prefetch lookup names, by field name or reverse accessor
+    for field in model._meta.get_fields():
+        if field.is_relation and name in (field.name, getattr(field, 'get_accessor_name', lambda: None)()):
+            return field
+    raise ValueError("%s has no relation called %r to prefetch." % (model.__name__, name))
+
+
+def _remote_field(field):
+    # Field.rel was renamed to Field.remote_field in Django 1.9
+    return getattr(field, 'remote_field', None) or field.rel
+
+
+def invalidate_dependents(model, using):
+    """Invalidate the get_active() entries that prefetch rows of model, once the current transaction commits"""
+    dependents = list(_prefetch_dependents.get(model._meta.concrete_model, ()))
+    if not dependents:
+        return
+
+    def invalidate():
+        for dependent in dependents:
+            invalidate_active(dependent, using)
+    on_commit(invalidate, using=using)
+
+
+def _related_changed(sender, using=None, **kwargs):
+    if kwargs.get('action', 'post_').startswith('post_'):
+        invalidate_dependents(sender, using)
+
+
+class OnlyOneActiveQuerySet(ActiveQuerySet):
+    def _update_published(self, rows, **kwargs):
+        count = super(OnlyOneActiveQuerySet, self)._update_published(rows, **kwargs)
+        self._invalidate_on_commit()
+        return count
+    _update_published.alters_data = True
+
+    def delete(self):
+        result = super(OnlyOneActiveQuerySet, self).delete()
+        self._invalidate_on_commit()
+        return result
+    delete.alters_data = True
+
+    def _rows_moved(self):
+        # get_active() falls back to the last changed row, which may have moved
+        super(OnlyOneActiveQuerySet, self)._rows_moved()
+        self._invalidate_on_commit()
+
+    def _invalidate_on_commit(self):
+        # like OnlyOneActiveModel.save(): a reader rebuilding before the commit would cache the old rows
+        model, using = self.model, self.db
+        on_commit(lambda: invalidate_active(model, using), using=using)
+
+
+class OnlyOneActiveManager(CustomQuerySetManager.from_queryset(OnlyOneActiveQuerySet), ArchiveManagerMixin,
+                           AsyncOnlyOneActiveManagerMixin):
+    def active_cache_key(self, version=None, prefetch=(), **scope):
+        scope = self._active_scope(scope)
+        if version is None:
+            version = get_versions(self._active_version_keys(scope))
+        return self._active_cache_key(version, prefetch, scope)
+
+    def invalidate_active(self, **scope):
+        invalidate_active(self.model, self.db, active_scope_items(self.model, scope) if scope else None)
+
+    def get_active(self, prefetch=None, **scope):
+        """Return the active row through the cache, or the last changed row when none is active.
+
+        prefetch is a list of prefetch_related() lookups to cache along with
+        it, by default the model's active_prefetch. Models with an
+        active_scope take its fields as keyword arguments, e.g. site=site.
+        """
+        prefetch = self._active_prefetch(prefetch)
+        scope = self._active_scope(scope)
+        namespace = self._active_local_key(prefetch, scope)
+        version_keys = self._active_version_keys(scope)
+        local = get_local_cache()
+        collector = get_collector()
+        if local is not None:
+            # the decoded instance is shared by every caller in this process
+            active, version = local.get(namespace, lambda: get_versions(version_keys))
+            if active is not MISSING:
+                if collector is not None:
+                    collector.incr('get_active.local_hit', model=model_label(self.model))
+                return active
+        else:
+            version = get_versions(version_keys)
+
+        timeout = self._active_timeout(prefetch)
+        key = self._active_cache_key(version, prefetch, scope)
+        transitions = []
+
+        def find_active():
+            active, transition = self._find_scheduled_active(prefetch, scope)
+            transitions.append(transition)
+            return active
+        refresh_by = lambda: transitions[-1]
+        if collector is None:
+            active, refresh_at = get_or_rebuild_entry(key, find_active, timeout, refresh_by)
+        else:
+            lookup = Lookup(collector, 'get_active', model_label(self.model), find_active)
+            active, refresh_at = get_or_rebuild_entry(key, lookup.rebuild, timeout, refresh_by)
+            lookup.done()
+        if local is not None:
+            # a scheduled switch or a capped timeout drops the local entry along with the shared one
+            local.set(namespace, version, active, self._local_timeout(prefetch, refresh_at))
         return active
+
+    def active_cache_entry(self, prefetch=None, **scope):
+        """Look up the active row and return the (key, value) get_active() would cache it as"""
+        prefetch = self._active_prefetch(prefetch)
+        scope = self._active_scope(scope)
+        # the version is read first, so a concurrent activation orphans this entry
+        version = get_versions(self._active_version_keys(scope))
+        timeout = self._active_timeout(prefetch)
+        active, transition = self._find_scheduled_active(prefetch, scope)
+        return (self._active_cache_key(version, prefetch, scope),
+                (active, refresh_time(time.time(), timeout, lambda: transition)))
+
+    def active_scopes(self):
+        """Return the get_active() keyword arguments of every scope that has rows, [{}] for unscoped models"""
+        names = list(getattr(self.model, 'active_scope', ()))
+        if not names:
+            return [{}]
+        return list(self.order_by().values(*names).distinct())
+
+    def _active_scope(self, scope):
+        return active_scope_items(self.model, scope)
+
+    def _active_cache_key(self, version, prefetch, scope):
+        key = 'basic_models:active:%s:%s' % (self._active_namespace(scope), version)
+        if prefetch:
+            key += ':%s' % _prefetch_digest(prefetch)
+        return key
+
+    def _find_active(self, prefetch=(), scope=()):
+        return self._find_scheduled_active(prefetch, scope)[0]
+
+    def _find_scheduled_active(self, prefetch=(), scope=()):
+        """Return the row get_active() returns now, and the time.time() the schedule next changes it or None.
+
+        A row with active_from is returned from then until its active_until, the
+        latest window to open winning, whether or not it is_active. Outside every
+        window the active row, or failing that the last changed one, is returned.
+        """
+        if not self._scheduled():
+            return self._active_candidates(scope).prefetch_related(*prefetch).first(), None
+        now = timezone.now()
+        rows = self.filter(**dict(scope))
+        active = rows.filter(Q(active_from__lte=now), Q(active_until__isnull=True) | Q(active_until__gt=now)) \
+            .order_by('-active_from', '-pk').prefetch_related(*prefetch).first()
+        if active is None:
+            active = self._active_candidates(scope).prefetch_related(*prefetch).first()
+        # one range query per column, so each is answered from its index
+        upcoming = [rows.filter(**{'%s__gt' % name: now}).aggregate(value=Min(name))['value']
+                    for name in ('active_from', 'active_until')]
+        transitions = [_timestamp(value) for value in upcoming if value is not None]
+        return active, min(transitions) if transitions else None
+
+    def _scheduled(self):
+        return any(field.name == 'active_from' for field in self.model._meta.concrete_fields)
+
+    def _active_prefetch(self, prefetch):
+        if prefetch is None:
+            prefetch = getattr(self.model, 'active_prefetch', ())
+        prefetch = tuple(prefetch)
+        if prefetch:
+            _register_prefetch(self.model, prefetch)
+        return prefetch
+
+    def _active_timeout(self, prefetch):
+        timeout = getattr(settings, "DEFAULT_CACHE_TIMEOUT", 900)
+        if not self._declared_prefetch(prefetch):
+            # only processes that have read these lookups watch them, so writes
+            # elsewhere go unnoticed until the entry expires
+            timeout = min(timeout, getattr(settings, 'BASIC_MODELS_PREFETCH_TIMEOUT', 60))
+        return timeout
+
+    def _declared_prefetch(self, prefetch):
+        return tuple(prefetch) == tuple(getattr(self.model, 'active_prefetch', ()))
+
+    def _local_timeout(self, prefetch, refresh_at):
+        if self._scheduled() or not self._declared_prefetch(prefetch):
+            return refresh_at - time.time()
+        return None
+
+    def _active_local_key(self, prefetch, scope=()):
+        namespace = self._active_namespace(scope)
+        if prefetch:
+            return '%s|%s' % (namespace, _prefetch_digest(prefetch))
+        return namespace
+
+    def _active_candidates(self, scope=()):
+        # the active row if there is one, otherwise the last one that was changed
+        fields = [field.name for field in self.model._meta.concrete_fields]
+        latest = '-updated_at' if 'updated_at' in fields else '-pk'
+        return self.filter(**dict(scope)).order_by('-is_active', latest)
+
+    def _active_namespace(self, scope=()):
+        return _active_namespace(self.model, self.db, scope)
+
+    def _active_version_keys(self, scope=()):
+        # a scope's entries are orphaned by its own counter or the model-wide one
+        keys = ['basic_models:active_version:%s' % self._active_namespace()]
+        if scope:
+            keys.append('basic_models:active_version:%s' % self._active_namespace(scope))
+        return keys
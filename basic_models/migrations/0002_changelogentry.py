@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '__first__'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('basic_models', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLogEntry',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('object_id', models.CharField(max_length=255)),
+                ('timestamp', models.DateTimeField()),
+                ('action', models.PositiveSmallIntegerField(choices=[(1, 'Addition'), (2, 'Change'), (3, 'Deletion')])),
+                ('changes', models.TextField(blank=True)),
+                ('content_type', models.ForeignKey(related_name='+', to='contenttypes.ContentType', db_index=False,
+                                                   on_delete=django.db.models.deletion.CASCADE)),
+                ('user', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.SET_NULL, blank=True,
+                                           to=settings.AUTH_USER_MODEL, null=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='changelogentry',
+            index_together=set([('content_type', 'object_id', 'timestamp')]),
+        ),
+    ]
@@ -16,50 +16,447 @@
 from django import forms
 from django.conf import settings
 from django.core.cache import cache
-from django.db import models
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, models, router, transaction
+from django.db.models.signals import class_prepared
 from django.template.defaultfilters import slugify
-from copy import deepcopy
+from django.utils import timezone
+from django.utils.encoding import force_text
+from copy import copy, deepcopy
+import json
 import re
+import sys
 
 from autoslug import AutoSlugField
+from basic_models.caching import (batch_publish, compress, decompress, is_packing, on_commit, publish_items,
+                                  unpublish_keys)
+from basic_models.changelog import encode_changes, record_changes
+from basic_models.indexes import RawIndex, default_indexes_enabled
 from basic_models.managers import *
+from basic_models.managers import _auto_now_updates, _remote_field
 import cachemodel
+from cachemodel.utils import generate_cache_key
 
-__all__ = ["ActiveModel","TimestampedModel","UserModel","DefaultModel","SlugModel","OnlyOneActiveModel"]
+__all__ = ["ActiveModel","TimestampedModel","ScheduledModel","UserModel","DefaultModel","SlugModel","OnlyOneActiveModel","ChangeLogEntry","Watermark"]
 
 
 _compat_auth_user_model = getattr(settings, 'AUTH_USER_MODEL', 'auth.User')
 
+_PACKED = 'basic_models.packed'
+
+
+def _has_field(model, name):
+    return any(field.name == name for field in model._meta.concrete_fields)
+
 
 class ActiveModel(cachemodel.CacheModel):
     is_active = models.BooleanField(default=True, db_index=True)
     objects = ActiveModelManager()
     active_objects = FilteredActiveObjectsManager()
 
+    # the field combinations instances are published under with publish_by()
+    cache_lookups = (('pk',),)
+
+    # create the indexes get_raw_indexes() declares when BASIC_MODELS_DEFAULT_INDEXES is on
+    default_indexes = True
+
+    # the compact form published instances are cached in: the names of the fields
+    # cached with the instance (None for all of them), the fields cached under keys
+    # of their own, and the pickled size in bytes from which entries are zlib
+    # compressed (None for BASIC_MODELS_CACHE_COMPRESS_THRESHOLD). Fields left out
+    # are loaded when first accessed.
+    cache_fields = None
+    cache_split_fields = ()
+    cache_compress_threshold = None
+
+    # attnames of the fields left out of, and split from, the cached instance;
+    # set by _prepare_cache_form()
+    _cache_omitted = ()
+    _cache_split = ()
+
+    # a timedelta: rows inactive and unchanged for this long can be moved to a
+    # <db_table>_archive table with objects.archive()
+    archive_after = None
+
+    # the model of that table, created by _prepare_archive()
+    _archive_model = None
+
     class Meta:
         abstract = True
 
+    @classmethod
+    def get_raw_indexes(cls):
+        """Return the RawIndex list that basic_models.indexes creates after migrate"""
+        indexes = getattr(super(ActiveModel, cls), 'get_raw_indexes', list)()
+        if default_indexes_enabled(cls) and _has_field(cls, 'updated_at'):
+            # active_objects listings and get_active() order by -updated_at, which
+            # both indexes serve with a backward scan
+            indexes.append(RawIndex(['is_active', 'updated_at']))
+            indexes.append(RawIndex(['updated_at'], where='is_active'))
+        return indexes
+
+    @classmethod
+    def cache_lookup_fields(cls):
+        return sorted(set(field for lookup in cls.cache_lookups for field in lookup))
+
+    @classmethod
+    def publish_many(cls, instances):
+        """Publish instances under every cache_lookups key with batched set_many() calls"""
+        items = {}
+        stale = []
+        using = None
+        for instance in instances:
+            using = instance._state.db
+            stale.extend(instance._stale_keys())
+            for lookup in cls.cache_lookups:
+                items[instance.publish_key(*lookup)] = instance
+            items.update(instance.split_field_items())
+        unpublish_keys(stale, using)
+        publish_items(items, using)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(ActiveModel, cls).from_db(db, field_names, values)
+        instance._published_lookups = instance._lookup_values()
+        return instance
+
+    def _lookup_values(self):
+        return dict((field, self.__dict__.get(field))
+                    for field in self.cache_lookup_fields() if field != 'pk')
+
+    def delete(self, *args, **kwargs):
+        unpublish_keys([self.publish_key(*lookup) for lookup in self.cache_lookups] +
+                       [self._split_key(attname, self.pk) for attname in self._cache_split], self._state.db)
+        super(ActiveModel, self).delete(*args, **kwargs)
+
+    def _stale_keys(self):
+        # keys published under values that have since changed (a renamed slug)
+        published = getattr(self, '_published_lookups', None)
+        current = self._lookup_values()
+        self._published_lookups = current
+        if not published or published == current:
+            return []
+        stale = set(self.published_keys([dict(published, pk=self.pk)]))
+        return list(stale - set(self.published_keys([dict(current, pk=self.pk)])))
+
+    def publish(self):
+        unpublish_keys(self._stale_keys(), self._state.db)
+
+        with batch_publish():
+            super(ActiveModel, self).publish()
+            for lookup in self.cache_lookups:
+                if lookup != ('pk',):
+                    self.publish_by(*lookup)
+            publish_items(self.split_field_items(), self._state.db)
+
+    def publish_by(self, *args):
+        publish_items({self.publish_key(*args): self}, self._state.db)
+
+    @classmethod
+    def published_keys(cls, rows):
+        """Return the cache keys published for rows, dicts holding the cache_lookup_fields() values"""
+        keys = []
+        for row in rows:
+            keys.extend(generate_cache_key([cls.__name__, "get"], **dict((field, row[field]) for field in lookup))
+                        for lookup in cls.cache_lookups)
+            keys.extend(cls._split_key(attname, row['pk']) for attname in cls._cache_split)
+        return keys
+
+    @classmethod
+    def _split_key(cls, attname, pk):
+        return generate_cache_key([cls.__name__, "field", attname], pk=pk)
+
+    @classmethod
+    def _prepare_cache_form(cls):
+        """Work out which fields the compact cache form leaves out, and make them load on access"""
+        if cls.cache_fields is None and not cls.cache_split_fields:
+            return
+        opts = cls._meta
+        split = [opts.get_field(name).attname for name in cls.cache_split_fields]
+        if cls.cache_fields is None:
+            kept = set(field.attname for field in opts.concrete_fields) - set(split)
+        else:
+            kept = set(opts.get_field(name).attname for name in cls.cache_fields)
+        # the cache lookups compare these against the keys they were published under
+        kept.add(opts.pk.attname)
+        kept.add('is_active')
+        kept.update(opts.get_field(name).attname for name in cls.cache_lookup_fields() if name != 'pk')
+        cls._cache_split = tuple(attname for attname in split if attname not in kept)
+        cls._cache_omitted = tuple(field.attname for field in opts.concrete_fields if field.attname not in kept)
+        for attname in cls._cache_omitted:
+            setattr(cls, attname, _OmittedField(attname, _class_attribute(cls, attname)))
+
+    @classmethod
+    def _prepare_archive(cls):
+        """Create the <Name>Archive model that archived rows are moved to"""
+        if cls.archive_after is None:
+            return
+        if cls._meta.parents:
+            raise ImproperlyConfigured("%s: multi-table inherited models can't be archived" % cls.__name__)
+        if not _has_field(cls, 'updated_at'):
+            raise ImproperlyConfigured("%s.archive_after needs an updated_at field" % cls.__name__)
+        opts = cls._meta
+        meta = type(str('Meta'), (object,), {
+            'app_label': opts.app_label,
+            'db_table': '%s_archive' % opts.db_table,
+            'managed': opts.managed,
+            'verbose_name': 'archived %s' % opts.verbose_name,
+            'verbose_name_plural': 'archived %s' % opts.verbose_name_plural,
+        })
+        attrs = {'__module__': cls.__module__, 'Meta': meta}
+        for field in opts.concrete_fields:
+            attrs[field.name] = _archive_field(field)
+        name = str('%sArchive' % cls.__name__)
+        cls._archive_model = type(name, (models.Model,), attrs)
+        cls._archive_model._archive_of = cls
+        # so its instances can be pickled
+        setattr(sys.modules[cls.__module__], name, cls._archive_model)
+
+    @classmethod
+    def _compress_threshold(cls):
+        if cls.cache_compress_threshold is not None:
+            return cls.cache_compress_threshold
+        return getattr(settings, 'BASIC_MODELS_CACHE_COMPRESS_THRESHOLD', None)
+
+    def split_field_items(self):
+        """Return the {key: value} cache entries of the loaded cache_split_fields"""
+        if self.pk is None:
+            return {}
+        threshold = self._compress_threshold()
+        return dict((self._split_key(attname, self.pk), compress(self.__dict__[attname], threshold))
+                    for attname in self._cache_split if attname in self.__dict__)
+
+    def __reduce__(self):
+        reduced = super(ActiveModel, self).__reduce__()
+        threshold = self._compress_threshold()
+        if not is_packing() or (not self._cache_omitted and threshold is None):
+            return reduced
+        # Django < 1.10 hands over __dict__ itself
+        state = dict(reduced[2])
+        omitted = tuple(attname for attname in self._cache_omitted if attname in state)
+        for attname in omitted:
+            del state[attname]
+        if omitted or self._cache_split:
+            # nor are the related instances it has loaded, which would bring their
+            # own large fields along
+            _drop_related_instances(self, state)
+        return reduced[:2] + ((_PACKED, omitted, compress(state, threshold)),)
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple) and state[0] == _PACKED:
+            omitted = set(state[1])
+            state = decompress(state[2])
+            state['_packed_omitted'] = omitted
+        super(ActiveModel, self).__setstate__(state)
+
+    def _load_omitted(self, attname):
+        omitted = self.__dict__['_packed_omitted']
+        if attname in self._cache_split:
+            entry = cache.get(self._split_key(attname, self.pk))
+            if entry is not None:
+                self.__dict__[attname] = decompress(entry)
+                omitted.discard(attname)
+                return
+        # one query for every omitted field that isn't cached under its own key
+        attnames = [name for name in omitted if name == attname or name not in self._cache_split]
+        values = self.__class__._base_manager.using(self._state.db).values(*attnames).get(pk=self.pk)
+        self.__dict__.update(values)
+        omitted.difference_update(attnames)
+
+
+class _OmittedField(object):
+    """Loads a field left out of a cached ActiveModel instance on first access"""
+
+    def __init__(self, attname, fallback):
+        self.attname = attname
+        self.fallback = fallback
+
+    def __get__(self, instance, owner):
+        if instance is not None and self.attname in instance.__dict__.get('_packed_omitted', ()):
+            instance._load_omitted(self.attname)
+            return instance.__dict__[self.attname]
+        if self.fallback is not None:
+            return self.fallback.__get__(instance, owner)
+        if instance is None:
+            return self
+        raise AttributeError(self.attname)
+
+
+def _drop_related_instances(instance, state):
+    for field in instance._meta.concrete_fields:
+        if field.is_relation:
+            state.pop(field.get_cache_name(), None)
+    fields_cache = getattr(state.get('_state'), 'fields_cache', None)
+    if fields_cache:
+        # Django >= 2.0 keeps them on _state
+        state['_state'] = copy(state['_state'])
+        state['_state'].fields_cache = {}
+
+
+_AUTO_FIELDS = {
+    'AutoField': models.IntegerField,
+    'BigAutoField': models.BigIntegerField,
+    'SmallAutoField': models.SmallIntegerField,
+}
+
+
+def _archive_field(field):
+    # a copy of field for the archive table: archived rows keep their primary
+    # keys, aren't unique against each other and don't constrain related rows
+    internal_type = field.get_internal_type()
+    if internal_type in _AUTO_FIELDS:
+        return _AUTO_FIELDS[internal_type](primary_key=True, serialize=False)
+    if field.is_relation:
+        # built by hand: deconstruct() needs a ready app registry for swappable models
+        remote_field = _remote_field(field)
+        return models.ForeignKey(remote_field.model, to_field=remote_field.field_name, db_column=field.db_column,
+                                 null=field.null, blank=field.blank, related_name='+', db_constraint=False,
+                                 on_delete=models.DO_NOTHING)
+    name, path, args, kwargs = field.deconstruct()
+    if kwargs.pop('unique', False) and not field.primary_key:
+        kwargs['db_index'] = True
+    return field.__class__(*args, **kwargs)
+
+
+def _class_attribute(cls, name):
+    # the descriptor Django put in place for name, if any (Django >= 1.10)
+    for klass in cls.__mro__:
+        if name in klass.__dict__:
+            return klass.__dict__[name]
+    return None
+
+
+def _prepare_cache_form(sender, **kwargs):
+    if issubclass(sender, ActiveModel) and not sender._meta.abstract and not sender._meta.proxy:
+        sender._prepare_cache_form()
+        sender._prepare_archive()
+
+class_prepared.connect(_prepare_cache_form)
+
 
 class TimestampedModel(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # also stamp updated_at in queryset.update(), the admin's activate and
+    # deactivate actions and OnlyOneActiveModel activation, for changed_since()
+    stamp_bulk_updates = False
+
+    class Meta:
+        abstract = True
+
+
+class ScheduledModel(models.Model):
+    """A window during which OnlyOneActiveModel.get_active() returns this row; see OnlyOneActiveModel"""
+    active_from = models.DateTimeField(blank=True, null=True)
+    active_until = models.DateTimeField(blank=True, null=True)
+
     class Meta:
         abstract = True
 
+    @classmethod
+    def get_raw_indexes(cls):
+        indexes = getattr(super(ScheduledModel, cls), 'get_raw_indexes', list)()
+        if default_indexes_enabled(cls):
+            # "the windows open now" and "when does the next window open or close"
+            scope = list(getattr(cls, 'active_scope', ()))
+            indexes.append(RawIndex(scope + ['active_from']))
+            indexes.append(RawIndex(scope + ['active_until']))
+        return indexes
+
 
 class UserModel(models.Model):
     created_by = models.ForeignKey(_compat_auth_user_model, related_name='%(app_label)s_%(class)s_created', null=True, blank=True, on_delete=models.SET_NULL)
     updated_by = models.ForeignKey(_compat_auth_user_model, related_name='%(app_label)s_%(class)s_updated', null=True, blank=True, on_delete=models.SET_NULL)
 
+    default_indexes = True
+
     class Meta:
         abstract = True
 
+    @classmethod
+    def get_raw_indexes(cls):
+        indexes = getattr(super(UserModel, cls), 'get_raw_indexes', list)()
+        if default_indexes_enabled(cls) and _has_field(cls, 'created_at'):
+            # "created by this user, newest first"
+            indexes.append(RawIndex(['created_by', 'created_at']))
+        return indexes
+
 
 class DefaultModel(UserModel, TimestampedModel, ActiveModel):
+    # record each save() and delete() as a ChangeLogEntry holding only the
+    # fields that changed; entries are written in bulk when the transaction commits
+    change_log = False
+
     class Meta:
         abstract = True
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(DefaultModel, cls).from_db(db, field_names, values)
+        if cls.change_log:
+            instance._change_log_values = instance._change_log_snapshot()
+        return instance
+
+    @classmethod
+    def change_log_fields(cls):
+        """The fields the change log follows: all but the primary key and the timestamps and users entries record"""
+        return [f for f in cls._meta.concrete_fields
+                if not f.primary_key and f.name not in ('created_at', 'updated_at', 'created_by', 'updated_by')]
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        super(DefaultModel, self).save(*args, **kwargs)
+        if self.change_log:
+            action = ChangeLogEntry.ADDITION if adding else ChangeLogEntry.CHANGE
+            entry = self.change_log_entry(action, kwargs.get('update_fields'))
+            if entry is not None:
+                record_changes([entry], self._state.db)
+
+    def delete(self, *args, **kwargs):
+        using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+        entry = self.change_log_entry(ChangeLogEntry.DELETION) if self.change_log else None
+        super(DefaultModel, self).delete(*args, **kwargs)
+        if entry is not None:
+            record_changes([entry], using)
+
+    def change_log_entry(self, action, update_fields=None):
+        """Return an unsaved ChangeLogEntry for action on this row, or None for a change that changed nothing.
+
+        The diff is taken against the values loaded from the database or
+        logged last, which the current values then replace.
+        """
+        from django.contrib.contenttypes.models import ContentType
+        current = self._change_log_snapshot()
+        previous = getattr(self, '_change_log_values', None)
+        if update_fields is not None:
+            attnames = set(self._meta.get_field(name).attname for name in update_fields)
+            current = dict((attname, value) for attname, value in current.items() if attname in attnames)
+        if action == ChangeLogEntry.DELETION:
+            changes = {}
+        elif action == ChangeLogEntry.ADDITION or previous is None:
+            changes = dict((attname, [None, value]) for attname, value in current.items() if value not in (None, ''))
+        else:
+            changes = dict((attname, [previous[attname], value]) for attname, value in current.items()
+                           if attname in previous and previous[attname] != value)
+            if not changes:
+                return None
+        self._change_log_values = dict(previous or {})
+        self._change_log_values.update(current)
+        using = self._state.db or router.db_for_write(self.__class__, instance=self)
+        return ChangeLogEntry(
+            content_type=ContentType.objects.db_manager(using).get_for_model(self.__class__),
+            object_id=force_text(self.pk),
+            timestamp=timezone.now(),
+            user_id=self.updated_by_id if action != ChangeLogEntry.DELETION else None,
+            action=action,
+            changes=encode_changes(changes) if changes else '',
+        )
+
+    def _change_log_snapshot(self):
+        return dict((f.attname, self.__dict__[f.attname])
+                    for f in self.change_log_fields() if f.attname in self.__dict__)
+
 
 class SlugModel(DefaultModel):
     name = models.CharField(max_length=1024)
@@ -67,6 +464,8 @@ class SlugModel(DefaultModel):
 
     objects = SlugModelManager()
 
+    cache_lookups = ActiveModel.cache_lookups + (('slug',),)
+
     class Meta:
         abstract = True
 
@@ -76,45 +475,229 @@ class SlugModel(DefaultModel):
     def __unicode__(self):
         return self.name
 
-    def publish(self):
-        super(SlugModel, self).publish()
-        self.publish_by('slug')
-
 
 class OnlyOneActiveModel(ActiveModel):
     objects = OnlyOneActiveManager()
 
+    # maximum rows per INSERT when clone() copies related rows, None for no limit
+    clone_batch_size = None
+
+    # lock the currently active row with SELECT ... FOR UPDATE before activating another one
+    activation_lock = False
+
+    # enforce a single active row with a partial unique index where the database supports one
+    unique_active_index = True
+
+    # index (is_active, updated_at) so get_active() finds its row straight from the
+    # index, even when default_indexes is off
+    active_index = False
+
+    # prefetch_related() lookups get_active() caches along with the row; the entry
+    # is invalidated whenever a row along them changes
+    active_prefetch = ()
+
+    # fields that partition the table, e.g. ('site',): one row is active per
+    # distinct value, and get_active() takes them as keyword arguments
+    active_scope = ()
+
     class Meta:
         abstract = True
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(OnlyOneActiveModel, cls).from_db(db, field_names, values)
+        if 'is_active' in field_names:
+            instance._loaded_is_active = instance.is_active
+        if all(cls._meta.get_field(name).attname in field_names for name in cls.active_scope):
+            instance._loaded_scope = instance.active_scope_items()
+        return instance
+
+    @classmethod
+    def get_raw_indexes(cls):
+        indexes = super(OnlyOneActiveModel, cls).get_raw_indexes()
+        scope = list(cls.active_scope)
+        if cls.unique_active_index:
+            indexes.append(RawIndex(scope + ['is_active'], where='is_active', unique=True))
+        if cls.active_index and _has_field(cls, 'updated_at'):
+            # without a scope, the same index as the default one, which is only created once
+            indexes.append(RawIndex(scope + ['is_active', 'updated_at']))
+        return indexes
+
+    def active_scope_items(self):
+        """Return the ((attname, value), ...) scope this row is active in"""
+        return tuple((field.attname, getattr(self, field.attname))
+                     for field in (self._meta.get_field(name) for name in self.active_scope))
+
     def save(self, *args, **kwargs):
-        super(OnlyOneActiveModel, self).save(*args, **kwargs)
-        if self.is_active:
-            self.__class__.objects.filter(is_active=True).exclude(pk=self.pk).update(is_active=False)
+        using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+        scope = self.active_scope_items()
+        if self._state.adding:
+            self._loaded_scope = scope
+        # a row moved to another scope while active takes over that scope
+        moved = getattr(self, '_loaded_scope', None) != scope
+        force_insert = kwargs.get('force_insert', args[0] if args else False)
+        activating = self.is_active and (
+            self._state.adding or self.pk is None or force_insert or moved or
+            not getattr(self, '_loaded_is_active', False))
+        # is_active hasn't changed since this row was loaded; _do_update() leaves
+        # it out of the UPDATE so a stale instance can't reactivate a row that
+        # another save has deactivated in the meantime
+        self._keep_is_active = (self.is_active and not activating and
+                                len(args) < 4 and kwargs.get('update_fields') is None)
+        try:
+            if activating:
+                with transaction.atomic(using=using):
+                    self._deactivate_others(using)
+                    super(OnlyOneActiveModel, self).save(*args, **kwargs)
+            else:
+                super(OnlyOneActiveModel, self).save(*args, **kwargs)
+        finally:
+            del self._keep_is_active
+        self._loaded_is_active = self.is_active
+        self._loaded_scope = scope
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        if getattr(self, '_keep_is_active', False):
+            values = [value for value in values if value[0].name != 'is_active']
+        updated = super(OnlyOneActiveModel, self)._do_update(
+            base_qs, using, pk_val, values, update_fields, forced_update)
+        if not updated and self.is_active:
+            # the row is gone and save() inserts it again, as the active one
+            self._deactivate_others(using)
+        return updated
+
+    def _deactivate_others(self, using):
+        others = self.__class__._base_manager.using(using).filter(is_active=True, **dict(self.active_scope_items()))
+        if self.pk is not None:
+            others = others.exclude(pk=self.pk)
+        if self.activation_lock and connections[using].features.has_select_for_update:
+            # concurrent activations queue up on the active row instead of both committing
+            list(others.select_for_update().values_list('pk', flat=True))
+        others.update(is_active=False, **_auto_now_updates(self.__class__))
+
+    def delete(self, *args, **kwargs):
+        using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+        scope = self.active_scope_items()
+        super(OnlyOneActiveModel, self).delete(*args, **kwargs)
+        on_commit(lambda: invalidate_active(self.__class__, using, scope), using=using)
 
     def publish(self):
         super(OnlyOneActiveModel, self).publish()
-        pass
-
-    def clone(self, *args, **kwargs):
-        new_obj = deepcopy(self)
-        new_obj.id = None
-        new_obj.is_active = False
-        new_obj.save()
-        reverse_foreignkeys = self._meta.get_all_related_objects()
-        for relation in reverse_foreignkeys:
-            relation_items = getattr(self, relation.get_accessor_name(), None) 
-            for item in relation_items.all():
-                new_item = deepcopy(item)
-                new_item.id = None
-                setattr(new_item, relation.field.name, new_obj)
-                new_item.save()
-        reverse_m2ms = self._meta.get_all_related_many_to_many_objects()
-        for relation in reverse_m2ms:
-            relation_items = getattr(self, relation.get_accessor_name(), None) 
-            for item in relation_items.all():
-                new_item = deepcopy(item)
-                new_item.id = None
-                setattr(new_item, relation.field.name, new_obj)
-                new_item.save()
-        return new_obj
\ No newline at end of file
+        using = self._state.db
+        scope = self.active_scope_items()
+        loaded = getattr(self, '_loaded_scope', None)
+        if loaded is None:
+            # the scope this row was saved in before is unknown; orphan them all
+            scopes = [None]
+        else:
+            scopes = set([scope, loaded])
+
+        def invalidate():
+            for scope in scopes:
+                invalidate_active(self.__class__, using, scope)
+        on_commit(invalidate, using=using)
+
+    def clone(self, batch_size=None):
+        """Copy this instance, its reverse foreign key rows and its many-to-many links as a new inactive row"""
+        # related rows are copied with bulk_create, so the number of queries
+        # depends on the number of relations rather than the number of rows
+        if batch_size is None:
+            batch_size = self.clone_batch_size
+        using = router.db_for_write(self.__class__, instance=self)
+        with transaction.atomic(using=using):
+            new_obj = deepcopy(self)
+            new_obj.pk = None
+            new_obj.is_active = False
+            if _has_field(self.__class__, 'active_from'):
+                # a copy must not take over the original's window
+                new_obj.active_from = new_obj.active_until = None
+            new_obj._state.adding = True
+            new_obj.save(using=using)
+
+            for relation in self._meta.get_fields():
+                if not relation.auto_created or relation.concrete:
+                    continue
+                if relation.one_to_many or (relation.one_to_one and not _remote_field(relation.field).parent_link):
+                    self._clone_reverse_foreignkey(relation, new_obj, using, batch_size)
+                elif relation.many_to_many:
+                    through = _remote_field(relation.field).through
+                    self._clone_m2m_links(through, relation.field.m2m_reverse_field_name(), new_obj, using, batch_size)
+
+            for field in self._meta.many_to_many:
+                through = _remote_field(field).through
+                self._clone_m2m_links(through, field.m2m_field_name(), new_obj, using, batch_size)
+        return new_obj
+
+    def _clone_reverse_foreignkey(self, relation, new_obj, using, batch_size):
+        model = relation.related_model
+        items = list(model._base_manager.using(using).filter(**{relation.field.name: self}))
+        for item in items:
+            item.pk = None
+            item._state.adding = True
+            setattr(item, relation.field.name, new_obj)
+        if model._meta.parents:
+            # bulk_create can't insert multi-table inherited rows
+            for item in items:
+                item.save(using=using)
+        elif hasattr(model._default_manager, 'bulk_create_with_slugs'):
+            # copies of SlugModel rows need fresh unique slugs
+            model._default_manager.db_manager(using).bulk_create_with_slugs(items, batch_size=batch_size)
+        else:
+            model._base_manager.using(using).bulk_create(items, batch_size=batch_size)
+
+    def _clone_m2m_links(self, through, field_name, new_obj, using, batch_size):
+        attname = through._meta.get_field(field_name).attname
+        links = list(through._base_manager.using(using).filter(**{attname: self.pk}))
+        for link in links:
+            link.pk = None
+            setattr(link, attname, new_obj.pk)
+        through._base_manager.using(using).bulk_create(links, batch_size=batch_size)
+
+
+class ChangeLogEntry(models.Model):
+    """One save() or delete() of a DefaultModel with change_log = True; the log is append-only"""
+    ADDITION = 1
+    CHANGE = 2
+    DELETION = 3
+    ACTION_CHOICES = (
+        (ADDITION, 'Addition'),
+        (CHANGE, 'Change'),
+        (DELETION, 'Deletion'),
+    )
+
+    # the composite index below serves content_type lookups on its own
+    content_type = models.ForeignKey('contenttypes.ContentType', related_name='+', db_index=False,
+                                     on_delete=models.CASCADE)
+    object_id = models.CharField(max_length=255)
+    timestamp = models.DateTimeField()
+    user = models.ForeignKey(_compat_auth_user_model, related_name='+', null=True, blank=True,
+                             on_delete=models.SET_NULL)
+    action = models.PositiveSmallIntegerField(choices=ACTION_CHOICES)
+    # {attname: [old value, new value]} as JSON, for the changed fields only
+    changes = models.TextField(blank=True)
+
+    objects = ChangeLogManager()
+
+    class Meta:
+        # basic_models/__init__.py imports this module before the app registry is ready
+        app_label = 'basic_models'
+        index_together = [('content_type', 'object_id', 'timestamp')]
+
+    def get_changes(self):
+        return json.loads(self.changes) if self.changes else {}
+
+
+class Watermark(models.Model):
+    """The position an incremental sync has reached, saved under a name; see WatermarkManager.iter_changes()"""
+    name = models.CharField(max_length=255, unique=True)
+    token = models.TextField(blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = WatermarkManager()
+
+    class Meta:
+        # basic_models/__init__.py imports this module before the app registry is ready
+        app_label = 'basic_models'
+
+    def __unicode__(self):
+        return self.name
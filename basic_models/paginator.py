@@ -0,0 +1,63 @@
+# Copyright 2011 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connections, transaction
+from django.utils.functional import cached_property
+
+__all__ = ['ApproximateCountPaginator']
+
+
+class ApproximateCountPaginator(Paginator):
+    """Paginator that takes the row count of an unfiltered queryset from the planner's statistics.
+
+    COUNT(*) scans the whole table on PostgreSQL and InnoDB. When the queryset
+    has no filters and the table statistics put it above
+    BASIC_MODELS_APPROXIMATE_COUNT_THRESHOLD rows (default 100000), that
+    estimate is used instead. Filtered querysets, smaller tables and other
+    backends are counted exactly.
+    """
+
+    @cached_property
+    def count(self):
+        estimate = self._estimate()
+        if estimate is not None and estimate >= getattr(settings, 'BASIC_MODELS_APPROXIMATE_COUNT_THRESHOLD', 100000):
+            return estimate
+        return super(ApproximateCountPaginator, self).count
+
+    def _estimate(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is None or query.where or query.distinct or query.low_mark or query.high_mark is not None:
+            return None
+        connection = connections[self.object_list.db]
+        table = self.object_list.model._meta.db_table
+        if connection.vendor == 'postgresql':
+            sql = "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass"
+            params = [connection.ops.quote_name(table)]
+        elif connection.vendor == 'mysql':
+            sql = "SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s"
+            params = [table]
+        else:
+            return None
+        try:
+            with transaction.atomic(using=self.object_list.db), connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                row = cursor.fetchone()
+        except DatabaseError:
+            return None
+        # reltuples is -1 for a table that has never been analyzed
+        if row is None or row[0] is None or row[0] < 0:
+            return None
+        return int(row[0])
@@ -1,7 +1,47 @@
-from django.test import TestCase
+import calendar
+import datetime
+import random
+import threading
+import time
+from copy import deepcopy
+from unittest import skipIf
 
+from django.contrib.admin import site
+from django.contrib.auth.models import User
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.core.management import call_command
+from django.db import IntegrityError, connection, reset_queries, transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from basic_models.admin import ActiveModelAdmin, ArchivedModelAdmin
+from basic_models.managers import (ActiveModelManager, ActiveQuerySet, CustomQuerySetManager,
+                                   OnlyOneActiveManager, SlugModelManager)
+from basic_models.caching import MISSING, LocalCache, batch_publish, bump_version, get_local_cache
+from basic_models.indexes import create_raw_indexes, supports_partial_indexes
+from basic_models.instrumentation import MemoryCollector, get_collector
+from basic_models.paginator import ApproximateCountPaginator
+from basic_models.warming import warm_caches
+from test_project.admin import PostAdmin
+from basic_models.models import ChangeLogEntry, Watermark
 from test_project.models import *
 
+try:
+    from test_project.asyncutils import TASKS_SHARE_CALLER_THREAD, collect, gather
+except (ImportError, SyntaxError):
+    # Python 2, or no asgiref
+    collect = gather = None
+    TASKS_SHARE_CALLER_THREAD = False
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    # Python 3
+    from io import StringIO
+
 
 class BasicModelsTestCase(TestCase):
 
@@ -22,6 +62,20 @@ class BasicModelsTestCase(TestCase):
         self.assertEqual(b_active[0].name, 'baz')
 
 
+    def test_manager_proxies_queryset_methods(self):
+        # proxies are real methods on the manager class, not __getattr__ lookups
+        self.assertTrue(callable(getattr(ActiveModelManager, 'active', None)))
+        self.assertIn('active', dir(Category.objects))
+        self.assertFalse(hasattr(Category.objects, 'no_such_method'))
+        self.assertEqual(Category.objects.db_manager('default').active().db, 'default')
+
+        # a queryset class handed to the constructor is still honoured
+        manager = CustomQuerySetManager(query_set=ActiveQuerySet)
+        manager.model = Category
+        Category.objects.create(name='foo', is_active=False)
+        self.assertEqual(manager.active().count(), 0)
+        self.assertFalse(hasattr(manager, 'no_such_method'))
+
     def test_slugmodel(self):
         #ensure that a slug is created by default
         post = Post.objects.create(
@@ -53,3 +107,1233 @@ class BasicModelsTestCase(TestCase):
         home.posts = Post.objects.all()
 
         # home = Homepage.objects.active_one()
+
+
+    def test_onlyoneactive_clone(self):
+        cat = Category.objects.create(name='foobar')
+        home = Homepage.objects.create(hero="hero", is_active=True)
+        for i in range(20):
+            post = Post.objects.create(category=cat, name="post %d" % i, body="body")
+            home.posts.add(post)
+            HomepageSection.objects.create(homepage=home, title="section %d" % i)
+
+        # savepoint, one insert for the homepage, one select and one insert for each
+        # of the sections and posts relations, release -- regardless of row counts
+        with self.assertNumQueries(7):
+            clone = home.clone()
+
+        self.assertNotEqual(clone.pk, home.pk)
+        self.assertFalse(clone.is_active)
+        self.assertEqual(clone.hero, home.hero)
+        self.assertEqual(clone.sections.count(), 20)
+        self.assertEqual(home.sections.count(), 20)
+        self.assertEqual(set(clone.posts.values_list('pk', flat=True)),
+                         set(home.posts.values_list('pk', flat=True)))
+        self.assertTrue(Homepage.objects.get(pk=home.pk).is_active)
+
+        # batch_size splits the inserts without adding per-row queries
+        with self.assertNumQueries(9):
+            home.clone(batch_size=10)
+
+    def test_onlyoneactive_activation(self):
+        first = Homepage.objects.create(hero="first", is_active=True)
+        second = Homepage.objects.create(hero="second", is_active=True)
+        self.assertEqual(list(Homepage.objects.filter(is_active=True)), [second])
+
+        # saving the row that is already active doesn't touch the others
+        second = Homepage.objects.get(pk=second.pk)
+        with self.assertNumQueries(1):
+            second.save()
+
+        first = Homepage.objects.get(pk=first.pk)
+        first.is_active = True
+        first.save()
+        self.assertEqual(list(Homepage.objects.filter(is_active=True)), [first])
+
+        # a stale instance of the row that used to be active doesn't reactivate it
+        second.hero = "edited"
+        second.save()
+        self.assertEqual(list(Homepage.objects.filter(is_active=True)), [first])
+        self.assertEqual(Homepage.objects.get(pk=second.pk).hero, "edited")
+
+    def test_onlyoneactive_resave_as_copy_or_after_delete(self):
+        original = Homepage.objects.create(hero="original", is_active=True)
+        copy = Homepage.objects.get_active()
+        copy.pk = None
+        copy.save()
+        self.assertEqual(Homepage.objects.count(), 2)
+        self.assertEqual(list(Homepage.objects.filter(is_active=True)), [copy])
+
+        # a row deleted behind the instance's back is inserted again
+        copy = Homepage.objects.get(pk=copy.pk)
+        Homepage.objects.filter(pk=copy.pk).delete()
+        copy.save()
+        self.assertEqual(list(Homepage.objects.filter(is_active=True)), [copy])
+        self.assertFalse(Homepage.objects.get(pk=original.pk).is_active)
+
+    def test_onlyoneactive_explicit_update_fields(self):
+        active = Homepage.objects.create(hero="hero", is_active=True)
+        active = Homepage.objects.get(pk=active.pk)
+        active.hero = "changed"
+        active.save(update_fields=['is_active'])
+        self.assertEqual(Homepage.objects.get(pk=active.pk).hero, "hero")
+        active.save(update_fields=['hero'])
+        self.assertEqual(Homepage.objects.get(pk=active.pk).hero, "changed")
+
+    @skipIf(not supports_partial_indexes(connection), "database has no partial indexes")
+    def test_onlyoneactive_unique_index(self):
+        Homepage.objects.create(hero="first", is_active=True)
+        second = Homepage.objects.create(hero="second", is_active=False)
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Homepage.objects.filter(pk=second.pk).update(is_active=True)
+
+
+
+class OnlyOneActiveCacheTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_get_active_is_cached_and_invalidated(self):
+        first = Homepage.objects.create(hero="first", is_active=True)
+        self.assertEqual(Homepage.objects.get_active(), first)
+        with self.assertNumQueries(0):
+            self.assertEqual(Homepage.objects.get_active(), first)
+
+        # activating another row publishes a new version of the cache key
+        second = Homepage.objects.create(hero="second", is_active=True)
+        self.assertEqual(Homepage.objects.get_active(), second)
+
+        # and so do bulk updates
+        Homepage.objects.filter(pk=second.pk).update(is_active=False)
+        Homepage.objects.filter(pk=first.pk).update(is_active=True)
+        self.assertEqual(Homepage.objects.get_active(), first)
+
+        first.delete()
+        self.assertEqual(Homepage.objects.get_active(), second)
+
+    def test_cache_key_is_namespaced(self):
+        key = Homepage.objects.active_cache_key()
+        self.assertTrue(key.startswith('basic_models:active:test_project.homepage:default:'))
+        Homepage.objects.invalidate_active()
+        self.assertNotEqual(Homepage.objects.active_cache_key(), key)
+
+    def test_stale_entry_served_while_another_process_rebuilds(self):
+        first = Homepage.objects.create(hero="first", is_active=True)
+        key = Homepage.objects.active_cache_key()
+        cache.set(key, (first, time.time() - 1), 60)
+
+        # someone else holds the rebuild lock, so the stale value is served
+        cache.add('%s:lock' % key, 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(Homepage.objects.get_active(), first)
+
+        # once the lock is released the next caller refreshes the entry
+        cache.delete('%s:lock' % key)
+        with self.assertNumQueries(1):
+            Homepage.objects.get_active()
+        self.assertGreater(cache.get(key)[1], time.time())
+
+
+    def test_get_active_fetches_one_row(self):
+        for i in range(5):
+            Homepage.objects.create(hero=str(i), is_active=False)
+        latest = Homepage.objects.create(hero="latest", is_active=False)
+
+        # no active row: falls back to the last one changed, still in one query
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(Homepage.objects.get_active(), latest)
+        self.assertEqual(len(queries), 1)
+        self.assertIn('LIMIT 1', queries[0]['sql'])
+
+        active = Homepage.objects.order_by('pk')[0]
+        active.is_active = True
+        active.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(Homepage.objects.get_active(), active)
+
+    def test_active_index_is_created(self):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, Homepage._meta.db_table)
+        self.assertIn('test_project_homepage_is_active_updated_at_idx', constraints)
+
+    def test_default_indexes_are_opt_in(self):
+        self.assertEqual(Category.get_raw_indexes(), [])
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, Category._meta.db_table)
+        self.assertNotIn('test_project_category_is_active_updated_at_idx', constraints)
+        # active_index still asks for its own index
+        self.assertEqual([index.fields for index in Homepage.get_raw_indexes()],
+                         [['is_active'], ['is_active', 'updated_at']])
+
+    @override_settings(BASIC_MODELS_DEFAULT_INDEXES=True)
+    def test_default_indexes_are_created(self):
+        create_raw_indexes(Category)
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, Category._meta.db_table)
+        self.assertIn('test_project_category_is_active_updated_at_idx', constraints)
+        self.assertIn('test_project_category_created_by_created_at_idx', constraints)
+        if supports_partial_indexes(connection):
+            self.assertIn('test_project_category_updated_at_part', constraints)
+
+        sql = [index.create_sql(Category, connection) for index in Category.get_raw_indexes()]
+        self.assertTrue(sql[1].endswith('WHERE %s' % connection.ops.quote_name('is_active')))
+
+    @override_settings(BASIC_MODELS_DEFAULT_INDEXES=True)
+    def test_default_indexes_opt_out(self):
+        Category.default_indexes = False
+        self.addCleanup(delattr, Category, 'default_indexes')
+        self.assertEqual(Category.get_raw_indexes(), [])
+
+    @override_settings(BASIC_MODELS_LOCAL_CACHE={'MAX_ENTRIES': 10, 'GRACE': 60})
+    def test_local_cache_serves_decoded_instance(self):
+        first = Homepage.objects.create(hero="first", is_active=True)
+        active = Homepage.objects.get_active()
+        self.assertIs(Homepage.objects.get_active(), active)
+        self.assertEqual(get_local_cache().hits, 1)
+
+        # writes in this process drop the local entry straight away
+        second = Homepage.objects.create(hero="second", is_active=True)
+        self.assertEqual(Homepage.objects.get_active(), second)
+
+    @override_settings(BASIC_MODELS_LOCAL_CACHE={'MAX_ENTRIES': 10, 'GRACE': 0})
+    def test_local_cache_checks_shared_version(self):
+        Homepage.objects.create(hero="first", is_active=True)
+        active = Homepage.objects.get_active()
+        self.assertIs(Homepage.objects.get_active(), active)
+
+        # a write from another process only reaches us through the shared version counter
+        Homepage._base_manager.filter(pk=active.pk).update(hero="changed")
+        self.assertEqual(Homepage.objects.get_active().hero, "first")
+        bump_version('basic_models:active_version:test_project.homepage:default')
+        self.assertEqual(Homepage.objects.get_active().hero, "changed")
+
+    def test_local_cache_is_bounded(self):
+        local = LocalCache(max_entries=2, grace=60)
+        for key in ('a', 'b', 'c'):
+            local.set(key, 1, key)
+        self.assertEqual(local.get('a', lambda: 1), (MISSING, 1))
+        self.assertEqual(local.get('c', lambda: 1), ('c', None))
+        self.assertEqual((local.hits, local.misses), (1, 1))
+
+
+class ActivePrefetchTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='foobar')
+        self.posts = [Post.objects.create(category=self.category, name="post %d" % i, body="body") for i in range(3)]
+        self.homepage = Homepage.objects.create(hero="hero", is_active=True)
+        self.homepage.posts.add(*self.posts[:2])
+
+    def render(self, prefetch=['posts__category']):
+        active = Homepage.objects.get_active(prefetch=prefetch)
+        return [(post.name, post.category.name) for post in active.posts.all()]
+
+    def test_cache_hit_runs_no_queries(self):
+        # the homepage, its posts and their categories
+        with self.assertNumQueries(3):
+            self.render()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.render(), [("post 0", "foobar"), ("post 1", "foobar")])
+        self.assertNotEqual(Homepage.objects.active_cache_key(prefetch=['posts__category']),
+                            Homepage.objects.active_cache_key())
+
+    def test_related_changes_invalidate(self):
+        self.render()
+        self.homepage.posts.add(self.posts[2])
+        self.assertEqual(len(self.render()), 3)
+
+        self.posts[0].name = "renamed"
+        self.posts[0].save()
+        self.assertIn(("renamed", "foobar"), self.render())
+
+        Category.objects.filter(pk=self.category.pk).update(name="bulk")
+        self.assertEqual(set(category for name, category in self.render()), set(["bulk"]))
+
+        self.homepage.posts.clear()
+        self.assertEqual(self.render(), [])
+
+    @override_settings(BASIC_MODELS_PREFETCH_TIMEOUT=5)
+    def test_ad_hoc_prefetch_entries_expire_sooner(self):
+        self.render()
+        key = Homepage.objects.active_cache_key(prefetch=['posts__category'])
+        self.assertLessEqual(cache.get(key)[1], time.time() + 5)
+        Homepage.objects.get_active()
+        self.assertGreater(cache.get(Homepage.objects.active_cache_key())[1], time.time() + 5)
+
+    def test_declared_prefetch(self):
+        Homepage.active_prefetch = ('posts',)
+        self.addCleanup(delattr, Homepage, 'active_prefetch')
+        Homepage.objects.get_active()
+        with self.assertNumQueries(0):
+            self.assertEqual(len(Homepage.objects.get_active().posts.all()), 2)
+
+
+class ActiveScopeTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.one = Site.objects.create(domain='one.example.com')
+        self.two = Site.objects.create(domain='two.example.com')
+
+    def test_one_active_row_per_scope(self):
+        first = Banner.objects.create(site=self.one, text="first", is_active=True)
+        other = Banner.objects.create(site=self.two, text="other", is_active=True)
+        second = Banner.objects.create(site=self.one, text="second", is_active=True)
+        self.assertEqual(set(Banner.objects.filter(is_active=True)), set([other, second]))
+        self.assertEqual(Banner.objects.get_active(site=self.one), second)
+        self.assertEqual(Banner.objects.get_active(site_id=self.two.pk), other)
+        self.assertFalse(Banner.objects.get(pk=first.pk).is_active)
+
+        # an active row moved to another site takes it over
+        second = Banner.objects.get(pk=second.pk)
+        second.site = self.two
+        second.save()
+        self.assertEqual(Banner.objects.get_active(site=self.two), second)
+        self.assertFalse(Banner.objects.get(pk=other.pk).is_active)
+        self.assertEqual(Banner.objects.get_active(site=self.one), first)
+
+    def test_scopes_are_cached_separately(self):
+        one = Banner.objects.create(site=self.one, text="one", is_active=True)
+        two = Banner.objects.create(site=self.two, text="two", is_active=True)
+        Banner.objects.get_active(site=self.one)
+        Banner.objects.get_active(site=self.two)
+        with self.assertNumQueries(0):
+            self.assertEqual(Banner.objects.get_active(site=self.one), one)
+            self.assertEqual(Banner.objects.get_active(site=self.two), two)
+
+        # a write in one scope leaves the other cached
+        Banner.objects.create(site=self.one, text="new", is_active=True)
+        with self.assertNumQueries(0):
+            self.assertEqual(Banner.objects.get_active(site=self.two), two)
+        self.assertEqual(Banner.objects.get_active(site=self.one).text, "new")
+
+        # bulk writes orphan every scope
+        Banner.objects.filter(pk=two.pk).update(text="changed")
+        self.assertEqual(Banner.objects.get_active(site=self.two).text, "changed")
+
+    def test_scope_is_required(self):
+        with self.assertRaises(TypeError):
+            Banner.objects.get_active()
+        with self.assertRaises(TypeError):
+            Homepage.objects.get_active(site=self.one)
+
+    def test_scoped_indexes(self):
+        self.assertEqual([index.fields for index in Banner.get_raw_indexes() if 'site' in index.fields],
+                         [['site', 'is_active'], ['site', 'is_active', 'updated_at']])
+        if supports_partial_indexes(connection):
+            Banner.objects.create(site=self.one, text="one", is_active=True)
+            Banner.objects.create(site=self.two, text="two", is_active=True)
+            with self.assertRaises(IntegrityError):
+                with transaction.atomic():
+                    Banner.objects.filter(site=self.two).update(site=self.one)
+
+
+class ChunkedIterationTestCase(TestCase):
+
+    def setUp(self):
+        self.categories = [Category.objects.create(name="category %d" % i, is_active=i % 3 != 0) for i in range(10)]
+
+    def test_iter_chunks(self):
+        # one query per full chunk, plus one for the last partial chunk
+        with self.assertNumQueries(4):
+            chunks = list(Category.objects.iter_chunks(3))
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 3, 3, 1])
+        self.assertEqual([c.pk for chunk in chunks for c in chunk], [c.pk for c in self.categories])
+
+        chunks = list(Category.objects.iter_active_chunks(3, fields=['name']))
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 3])
+        self.assertEqual([row for chunk in chunks for row in chunk],
+                         [(c.name,) for c in self.categories if c.is_active])
+
+    def test_iter_chunks_resumes_from_token(self):
+        chunks = Category.objects.iter_chunks(4)
+        next(chunks)
+        token = next(chunks).token
+        resumed = list(Category.objects.iter_chunks(4, token=token))
+        self.assertEqual([c.pk for chunk in resumed for c in chunk], [c.pk for c in self.categories[8:]])
+        self.assertRaises(ValueError, lambda: list(Category.objects.iter_chunks(4, key='updated_at', token=token)))
+
+    def test_iter_chunks_by_updated_at(self):
+        # ties on updated_at are broken by pk
+        Category.objects.filter(pk__in=[c.pk for c in self.categories[:6]]).update(updated_at=self.categories[0].updated_at)
+        self.categories[1].save()
+
+        chunks = list(Category.objects.iter_chunks(2, fields=['name'], key='updated_at'))
+        expected = [c.name for c in self.categories[:6] if c != self.categories[1]]
+        expected += [c.name for c in self.categories[6:]] + [self.categories[1].name]
+        self.assertEqual([name for chunk in chunks for (name,) in chunk], expected)
+
+        resumed = list(Category.objects.iter_chunks(2, fields=['name'], key='updated_at', token=chunks[1].token))
+        self.assertEqual([name for chunk in resumed for (name,) in chunk], expected[4:])
+
+    def test_iter_chunks_with_uuid_keys(self):
+        tags = sorted((Tag.objects.create(name="tag %d" % i) for i in range(5)), key=lambda tag: tag.pk)
+        chunks = list(Tag.objects.iter_chunks(2))
+        self.assertEqual([tag.pk for chunk in chunks for tag in chunk], [tag.pk for tag in tags])
+        resumed = list(Tag.objects.iter_chunks(2, token=chunks[0].token))
+        self.assertEqual([tag.pk for chunk in resumed for tag in chunk], [tag.pk for tag in tags[2:]])
+
+        chunks = list(Tag.objects.iter_chunks(2, fields=['name'], key='updated_at'))
+        self.assertEqual(len(Tag.objects.changed_since(chunks[0].token)), 3)
+
+
+class ChangedSinceTestCase(TestCase):
+
+    def setUp(self):
+        self.categories = [Category.objects.create(name="category %d" % i) for i in range(6)]
+
+    def test_changed_since(self):
+        chunks = list(Category.objects.changed_since(None).iter_chunks(4, key='updated_at'))
+        self.assertEqual([c.pk for chunk in chunks for c in chunk], [c.pk for c in self.categories])
+
+        self.categories[2].save()
+        changed = Category.objects.changed_since(chunks[-1].token)
+        self.assertEqual(list(changed), [self.categories[2]])
+        self.assertEqual(list(Category.objects.changed_since(self.categories[5].updated_at)), [self.categories[2]])
+
+    def test_changed_since_overlap(self):
+        token = list(Category.objects.iter_chunks(10, key='updated_at'))[-1].token
+        # a row stamped before the watermark whose transaction committed after it
+        late = self.categories[5].updated_at - datetime.timedelta(seconds=1)
+        Category.objects.filter(pk=self.categories[0].pk).update(name="late", updated_at=late)
+        self.assertEqual(list(Category.objects.changed_since(token)), [])
+        overlap = datetime.timedelta(seconds=2)
+        self.assertEqual(list(Category.objects.changed_since(token, overlap))[0].name, "late")
+        self.assertIn("late", [c.name for c in Category.objects.changed_since(self.categories[5].updated_at, overlap)])
+
+    def test_queryset_update_stamps_updated_at(self):
+        token = list(Category.objects.iter_chunks(10, key='updated_at'))[-1].token
+        Category.objects.filter(pk=self.categories[0].pk).update(name="renamed")
+        self.assertEqual(list(Category.objects.changed_since(token)), [])
+
+        Category.stamp_bulk_updates = True
+        self.addCleanup(delattr, Category, 'stamp_bulk_updates')
+        Category.objects.filter(pk=self.categories[1].pk).update(name="stamped")
+        self.assertEqual([c.name for c in Category.objects.changed_since(token)], ["stamped"])
+
+    def test_admin_actions_stamp_updated_at(self):
+        Category.stamp_bulk_updates = True
+        self.addCleanup(delattr, Category, 'stamp_bulk_updates')
+        token = list(Category.objects.iter_chunks(10, key='updated_at'))[-1].token
+        request = RequestFactory().post('/')
+        request.session = {}
+        request._messages = FallbackStorage(request)
+        ActiveModelAdmin(Category, site).deactivate_objects(request, Category.objects.filter(pk=self.categories[3].pk))
+        self.assertEqual(list(Category.objects.changed_since(token)), [self.categories[3]])
+
+    def test_watermark_iter_changes(self):
+        seen = []
+        for chunk in Watermark.objects.iter_changes('indexer', Category.objects.all(), size=4):
+            seen.extend(chunk)
+        self.assertEqual(seen, self.categories)
+        self.assertEqual(list(Watermark.objects.iter_changes('indexer', Category.objects.all())), [])
+
+        self.categories[1].save()
+        changes = Watermark.objects.iter_changes('indexer', Category.objects.all(), size=1)
+        self.assertEqual(list(next(changes)), [self.categories[1]])
+        # the watermark only moves once the chunk has been processed
+        self.assertEqual(len(list(Watermark.objects.iter_changes('indexer', Category.objects.all()))[0]), 1)
+        self.assertEqual(list(Watermark.objects.iter_changes('indexer', Category.objects.all())), [])
+
+
+class InstrumentationTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(get_collector())
+
+    @override_settings(BASIC_MODELS_METRICS=True)
+    def test_memory_collector(self):
+        metrics = get_collector()
+        self.assertIsInstance(metrics, MemoryCollector)
+
+        Homepage.objects.create(hero="active", is_active=True)
+        Homepage.objects.get_active()
+        Homepage.objects.get_active()
+        self.assertEqual(metrics.counter('get_active.miss', 'test_project.homepage'), 1)
+        self.assertEqual(metrics.counter('get_active.hit', 'test_project.homepage'), 1)
+        self.assertEqual(metrics.snapshot()['timings']['get_active.rebuild:test_project.homepage']['count'], 1)
+
+        category = Category.objects.create(name='foobar')
+        post = Post.objects.create(category=category, name="hello", body="body")
+        self.assertEqual(metrics.counter('publish.keys'), 4)
+        cache.clear()
+        Post.objects.get_by_natural_key(post.slug)
+        Post.objects.get_by_natural_key(post.slug)
+        self.assertEqual(metrics.counter('natural_key.miss', 'test_project.post'), 1)
+        self.assertEqual(metrics.counter('natural_key.hit', 'test_project.post'), 1)
+
+        request = RequestFactory().post('/')
+        request.session = {}
+        request._messages = FallbackStorage(request)
+        ActiveModelAdmin(Post, site).deactivate_objects(request, Post.objects.all())
+        self.assertEqual(metrics.counter('admin.deactivate.rows', 'test_project.post'), 1)
+
+        histogram = metrics.snapshot()['timings']['admin.deactivate:test_project.post']
+        self.assertEqual(sum(histogram['buckets']), 1)
+        self.assertEqual(len(histogram['buckets']), len(MemoryCollector.buckets) + 1)
+
+
+class PublishTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='foobar')
+        self.set_many_calls = []
+        set_many = cache.set_many
+
+        def counting_set_many(data, *args, **kwargs):
+            self.set_many_calls.append(sorted(data))
+            return set_many(data, *args, **kwargs)
+        cache.set_many = counting_set_many
+        self.addCleanup(delattr, cache, 'set_many')
+
+    def test_save_publishes_pk_and_slug_in_one_call(self):
+        post = Post.objects.create(category=self.category, name="hello", body="body")
+        self.assertEqual(self.set_many_calls, [sorted([post.publish_key('pk'), post.publish_key('slug')])])
+        self.assertEqual(cache.get(post.publish_key('slug')), post)
+
+    def test_batch_publish_coalesces_saves(self):
+        with batch_publish():
+            posts = [Post.objects.create(category=self.category, name="post %d" % i, body="body")
+                     for i in range(3)]
+            self.assertIsNone(cache.get(posts[0].publish_key('pk')))
+        self.assertEqual(len(self.set_many_calls), 1)
+        self.assertEqual(cache.get(posts[2].publish_key('slug')), posts[2])
+
+    def test_queryset_publish(self):
+        for i in range(5):
+            Post.objects.create(category=self.category, name="post %d" % i, body="body")
+        cache.clear()
+        del self.set_many_calls[:]
+
+        Post.objects.all().publish(batch_size=2)
+        self.assertEqual(len(self.set_many_calls), 3)
+        for post in Post.objects.all():
+            self.assertEqual(Post.cached.get(pk=post.pk), post)
+            self.assertEqual(cache.get(post.publish_key('slug')), post)
+
+
+class CacheFormTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='foobar')
+        self.post = Post.objects.create(category=self.category, name="hello", body="body")
+
+    def test_whitelist_loads_omitted_fields_in_one_query(self):
+        cached = cache.get(self.category.publish_key('pk'))
+        self.assertEqual(cached.name, 'foobar')
+        self.assertNotIn('created_at', cached.__dict__)
+        with self.assertNumQueries(1):
+            self.assertEqual(cached.created_at, self.category.created_at)
+            self.assertEqual(cached.updated_at, self.category.updated_at)
+
+    def test_split_field_is_cached_under_its_own_key(self):
+        comment = Comment.objects.create(post=self.post, name="comment", body="x" * 1000)
+        comment.post  # loaded instances of related models aren't cached along
+        cached = cache.get(comment.publish_key('slug'))
+        self.assertNotIn('body', cached.__dict__)
+        with self.assertNumQueries(0):
+            self.assertEqual(cached.body, "x" * 1000)
+        with self.assertNumQueries(1):
+            self.assertEqual(cached.post, self.post)
+
+        comment.delete()
+        self.assertIsNone(cache.get(Comment._split_key('body', cached.pk)))
+
+    def test_split_field_falls_back_to_the_database(self):
+        comment = Comment.objects.create(post=self.post, name="comment", body="body")
+        cached = cache.get(comment.publish_key('pk'))
+        cache.delete(Comment._split_key('body', comment.pk))
+        with self.assertNumQueries(1):
+            self.assertEqual(cached.body, "body")
+
+    def test_compression(self):
+        with self.settings(BASIC_MODELS_CACHE_COMPRESS_THRESHOLD=100):
+            comment = Comment.objects.create(post=self.post, name="comment", body="x" * 1000)
+            self.assertEqual(cache.get(Comment._split_key('body', comment.pk))[0], 'z')
+            cached = cache.get(comment.publish_key('pk'))
+            self.assertEqual((cached.name, cached.body), ("comment", "x" * 1000))
+
+    def test_copies_outside_the_cache_are_complete(self):
+        category = deepcopy(Category.objects.get(pk=self.category.pk))
+        self.assertIn('created_at', category.__dict__)
+
+
+class NaturalKeyTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='foobar')
+        self.posts = [Post.objects.create(category=self.category, name="post %d" % i, body="body")
+                      for i in range(3)]
+
+    def test_get_by_natural_key_reads_through_cache(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(Post.objects.get_by_natural_key("post-0"), self.posts[0])
+
+        cache.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(Post.objects.get_by_natural_key("post-0"), self.posts[0])
+        with self.assertNumQueries(0):
+            self.assertEqual(Post.objects.get_by_natural_key("post-0"), self.posts[0])
+
+    def test_stale_slug_entries_are_ignored(self):
+        post = self.posts[0]
+        post.slug = "renamed"
+        post.save()
+        with self.assertRaises(Post.DoesNotExist):
+            Post.objects.get_by_natural_key("post-0")
+
+        self.posts[1].delete()
+        with self.assertRaises(Post.DoesNotExist):
+            Post.objects.get_by_natural_key("post-1")
+
+        Post.objects.filter(pk=self.posts[2].pk).delete()
+        with self.assertRaises(Post.DoesNotExist):
+            Post.objects.get_by_natural_key("post-2")
+
+    def test_bulk_create_with_slugs(self):
+        names = ["Hello", "Hello", "post 0", "Hello world", "hello", "fresh"]
+        posts = [Post(category=self.category, name=name, body="body") for name in names]
+        Post.objects.create(category=self.category, name="Hello")
+
+        # savepoint, one slug__in query, prefix queries for "hello" and "post-0", one insert,
+        # one query for the new primary keys, release
+        with self.assertNumQueries(7):
+            Post.objects.bulk_create_with_slugs(posts)
+        self.assertEqual([post.slug for post in posts],
+                         ["hello-2", "hello-3", "post-0-2", "hello-world", "hello-4", "fresh"])
+        self.assertEqual(Post.objects.filter(slug__startswith="hello").count(), 5)
+        self.assertIsNotNone(Post.objects.get(slug="fresh").created_at)
+
+        # saving one of them again updates its row
+        self.assertEqual(posts[-1], Post.objects.get(slug="fresh"))
+        posts[-1].body = "edited"
+        posts[-1].save()
+        self.assertEqual(Post.objects.filter(slug="fresh").count(), 1)
+        self.assertEqual(Post.objects.get(slug="fresh").body, "edited")
+
+    def test_bulk_create_with_slugs_truncated(self):
+        # at max_length the suffix replaces the end of the slug
+        name = "x" * 300
+        first = Post.objects.create(category=self.category, name=name)
+        second = Post.objects.create(category=self.category, name=name)
+        self.assertEqual(len(second.slug), 255)
+        posts = Post.objects.bulk_create_with_slugs(Post(category=self.category, name=name) for i in range(2))
+        slugs = [first.slug, second.slug] + [post.slug for post in posts]
+        self.assertEqual(len(set(slugs)), 4)
+        self.assertTrue(all(len(slug) <= 255 for slug in slugs))
+
+    def test_get_many_by_natural_keys(self):
+        cache.delete(self.posts[1].publish_key('slug'))
+        # the one miss costs a single slug__in query, then it is backfilled
+        with self.assertNumQueries(1):
+            found = Post.objects.get_many_by_natural_keys(["post-0", "post-1", "post-2", "nope"])
+        self.assertEqual(found, dict((post.slug, post) for post in self.posts))
+        with self.assertNumQueries(0):
+            Post.objects.get_many_by_natural_keys(["post-0", "post-1", "post-2"])
+
+
+class PublishOnCommitTestCase(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    @skipIf(not hasattr(transaction, 'on_commit'), "Django < 1.9 has no commit hooks")
+    def test_rolled_back_saves_are_not_published(self):
+        category = Category.objects.create(name='foobar')
+        try:
+            with transaction.atomic():
+                post = Post.objects.create(category=category, name="hello", body="body")
+                self.assertIsNone(cache.get(post.publish_key('pk')))
+                raise IntegrityError
+        except IntegrityError:
+            pass
+        self.assertIsNone(cache.get(post.publish_key('pk')))
+
+        with transaction.atomic():
+            post = Post.objects.create(category=category, name="hello", body="body")
+        self.assertEqual(cache.get(post.publish_key('pk')), post)
+
+    @skipIf(not hasattr(transaction, 'on_commit'), "Django < 1.9 has no commit hooks")
+    def test_rolled_back_savepoints_drop_their_change_log_entries(self):
+        Category.change_log = True
+        self.addCleanup(delattr, Category, 'change_log')
+        with transaction.atomic():
+            kept = Category.objects.create(name='kept')
+            try:
+                with transaction.atomic():
+                    Category.objects.create(name='dropped')
+                    raise IntegrityError
+            except IntegrityError:
+                pass
+            self.assertEqual(ChangeLogEntry.objects.count(), 0)
+        self.assertEqual(list(ChangeLogEntry.objects.values_list('object_id', flat=True)), [str(kept.pk)])
+
+    def test_deletes_drop_held_publishes(self):
+        category = Category.objects.create(name='foobar')
+        with transaction.atomic():
+            post = Post.objects.create(category=category, name="hello", body="body")
+            keys = [post.publish_key('pk'), post.publish_key('slug')]
+            post.delete()
+        self.assertEqual(cache.get_many(keys), {})
+
+        with transaction.atomic():
+            post = Post.objects.create(category=category, name="hello", body="body")
+            keys = [post.publish_key('pk'), post.publish_key('slug')]
+            Post.objects.filter(pk=post.pk).delete()
+        self.assertEqual(cache.get_many(keys), {})
+
+        with batch_publish():
+            post = Post.objects.create(category=category, name="hello", body="body")
+            keys = [post.publish_key('pk'), post.publish_key('slug')]
+            post.delete()
+        self.assertEqual(cache.get_many(keys), {})
+
+    def test_bulk_updates_drop_held_publishes(self):
+        category = Category.objects.create(name='foobar')
+        with batch_publish():
+            post = Post.objects.create(category=category, name="hello", body="body")
+            Post.objects.filter(pk=post.pk).update(body="changed")
+        self.assertIsNone(cache.get(post.publish_key('pk')))
+        self.assertEqual(Post.cached.get(pk=post.pk).body, "changed")
+
+    def test_bulk_updates_drop_published_entries(self):
+        category = Category.objects.create(name='foobar')
+        post = Post.objects.create(category=category, name="hello", body="body")
+        self.assertEqual(Post.objects.get_by_natural_key("hello").body, "body")
+
+        Post.objects.filter(pk=post.pk).update(is_active=False, body="changed")
+        post = Post.objects.get_by_natural_key("hello")
+        self.assertEqual((post.is_active, post.body), (False, "changed"))
+
+        # the entry under the old slug goes too
+        Post.objects.filter(pk=post.pk).update(slug="renamed")
+        self.assertRaises(Post.DoesNotExist, Post.objects.get_by_natural_key, "hello")
+        self.assertEqual(Post.objects.get_by_natural_key("renamed").pk, post.pk)
+
+    @skipIf(not hasattr(transaction, 'on_commit'), "Django < 1.9 has no commit hooks")
+    def test_bulk_updates_drop_entries_cached_before_the_commit(self):
+        category = Category.objects.create(name='foobar')
+        post = Post.objects.create(category=category, name="hello", body="body")
+        with transaction.atomic():
+            Post.objects.filter(pk=post.pk).update(body="changed")
+            # a reader that caches the row as it was before the commit
+            cache.set(post.publish_key('slug'), post)
+        self.assertEqual(Post.objects.get_by_natural_key("hello").body, "changed")
+
+    @skipIf(not hasattr(transaction, 'on_commit'), "Django < 1.9 has no commit hooks")
+    def test_bulk_updates_invalidate_active_on_commit(self):
+        first = Homepage.objects.create(hero="first", is_active=True)
+        second = Homepage.objects.create(hero="second", is_active=False)
+        with transaction.atomic():
+            Homepage.objects.filter(pk=first.pk).update(is_active=False)
+            Homepage.objects.filter(pk=second.pk).update(is_active=True)
+            # a reader outside the transaction would still see the first row
+            cache.set(Homepage.objects.active_cache_key(), (first, time.time() + 60))
+        self.assertEqual(Homepage.objects.get_active(), second)
+
+        with transaction.atomic():
+            Homepage.objects.filter(pk=second.pk).delete()
+            cache.set(Homepage.objects.active_cache_key(), (second, time.time() + 60))
+        self.assertEqual(Homepage.objects.get_active(), first)
+
+    @skipIf(not hasattr(transaction, 'on_commit'), "Django < 1.9 has no commit hooks")
+    def test_related_changes_invalidate_active_on_commit(self):
+        category = Category.objects.create(name='foobar')
+        post = Post.objects.create(category=category, name="hello", body="body")
+        homepage = Homepage.objects.create(hero="hero", is_active=True)
+        homepage.posts.add(post)
+        stale = Homepage.objects.get_active(prefetch=['posts'])
+        with transaction.atomic():
+            post.name = "renamed"
+            post.save()
+            # a reader outside the transaction would still see the old name
+            cache.set(Homepage.objects.active_cache_key(prefetch=['posts']), (stale, time.time() + 60))
+        self.assertEqual([p.name for p in Homepage.objects.get_active(prefetch=['posts']).posts.all()], ["renamed"])
+
+
+class ActiveModelAdminTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.request = RequestFactory().post('/')
+        self.request.session = {}
+        self.request._messages = FallbackStorage(self.request)
+
+    def test_bulk_actions_drop_published_cache_entries(self):
+        category = Category.objects.create(name='foobar')
+        posts = [Post.objects.create(category=category, name="post %d" % i, body="body") for i in range(5)]
+        self.assertEqual(Post.cached.get(pk=posts[0].pk).is_active, True)
+        self.assertEqual(cache.get(posts[0].publish_key('slug')).is_active, True)
+
+        admin = ActiveModelAdmin(Post, site)
+        admin.action_chunk_size = 2
+        # one select for the rows, then one update per chunk of two
+        with self.assertNumQueries(4):
+            admin.deactivate_objects(self.request, Post.objects.all())
+
+        self.assertEqual(Post.objects.active().count(), 0)
+        self.assertIsNone(cache.get(posts[0].publish_key('pk')))
+        self.assertIsNone(cache.get(posts[0].publish_key('slug')))
+        self.assertEqual(Post.cached.get(pk=posts[0].pk).is_active, False)
+        self.assertIn("Successfully deactivated 5 posts", str(list(self.request._messages)[0]))
+
+
+class ArchiveTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        long_ago = timezone.now() - datetime.timedelta(days=400)
+        self.old = [Category.objects.create(name="old %d" % i, is_active=False) for i in range(5)]
+        self.referenced = Category.objects.create(name="referenced", is_active=False)
+        Post.objects.create(category=self.referenced, name="post", body="body")
+        self.recent = Category.objects.create(name="recent", is_active=False)
+        self.active = Category.objects.create(name="active")
+        Category.objects.exclude(pk=self.recent.pk).update(updated_at=long_ago)
+
+    def test_archive_moves_old_inactive_rows(self):
+        self.old[0].publish()
+        self.assertIsNotNone(cache.get(self.old[0].publish_key('pk')))
+        reset_queries()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(Category.objects.archive(batch_size=2), 5)
+        # one INSERT ... SELECT and one DELETE per batch of two
+        inserts = [query for query in queries if 'INSERT INTO' in query['sql']]
+        deletes = [query for query in queries if 'DELETE FROM' in query['sql']]
+        self.assertEqual((len(inserts), len(deletes)), (3, 3))
+
+        self.assertEqual(set(Category.objects.all()), set([self.referenced, self.recent, self.active]))
+        self.assertEqual(Category.objects.archived().get(pk=self.old[0].pk).name, "old 0")
+        self.assertIsNone(cache.get(self.old[0].publish_key('pk')))
+        self.assertEqual(Category.objects.archive(), 0)
+
+    def test_read_across_archive(self):
+        Category.objects.archive()
+        archived = Category.objects.get_with_archived(pk=self.old[1].pk)
+        self.assertIsInstance(archived, Category)
+        self.assertTrue(archived._archived)
+        self.assertEqual((archived.pk, archived.name), (self.old[1].pk, "old 1"))
+        self.assertRaises(Category.DoesNotExist, Category.objects.get_with_archived, pk=-1)
+        self.assertEqual(len(list(Category.objects.with_archived(is_active=False))), 7)
+
+    def test_restore(self):
+        Category.objects.archive()
+        self.assertEqual(Category.objects.restore_archived([self.old[0].pk, self.old[1].pk]), 2)
+        self.assertEqual(Category.objects.get(pk=self.old[0].pk).name, "old 0")
+        self.assertEqual(Category.objects.archived().count(), 3)
+
+    def test_archived_model_admin(self):
+        Category.objects.archive()
+        archive_admin = site._registry[CategoryArchive]
+        user = User.objects.create(username='editor', is_staff=True, is_superuser=True)
+        request = RequestFactory().get('/')
+        request.user = user
+        response = archive_admin.changelist_view(request)
+        self.assertEqual(set(response.context_data['cl'].result_list), set(Category.objects.archived()))
+        self.assertEqual([name for name, label in archive_admin.get_action_choices(request)[1:]], ['restore_objects'])
+        self.assertFalse(archive_admin.has_add_permission(request))
+
+        # the archived rows open read-only under their own admin
+        response = archive_admin.change_view(request, str(self.old[2].pk))
+        self.assertEqual(response.status_code, 200)
+        request = RequestFactory().post('/')
+        request.user = user
+        self.assertRaises(PermissionDenied, archive_admin.change_view, request, str(self.old[2].pk))
+
+        # and the live changelist only lists live rows
+        request = RequestFactory().get('/')
+        request.user = user
+        response = ActiveModelAdmin(Category, site).changelist_view(request)
+        self.assertEqual(set(response.context_data['cl'].result_list), set(Category.objects.all()))
+
+    def test_archived_model_admin_restores_rows(self):
+        Category.objects.archive()
+        request = RequestFactory().post('/')
+        request.session = {}
+        request._messages = FallbackStorage(request)
+        site._registry[CategoryArchive].restore_objects(request, Category.objects.archived().filter(pk=self.old[2].pk))
+        self.assertTrue(Category.objects.get(pk=self.old[2].pk).is_active)
+        self.assertFalse(Category.objects.archived().filter(pk=self.old[2].pk).exists())
+
+    def test_restore_with_taken_unique_values(self):
+        first = Topic.objects.create(name="hello", is_active=False)
+        second = Topic.objects.create(name="hello", code="b", is_active=False)
+        self.assertEqual((first.slug, second.slug), ("hello", "hello-2"))
+        Topic.objects.update(updated_at=timezone.now() - datetime.timedelta(days=400))
+        Topic.objects.archive()
+        # new rows take the slug of the first and the code of the second
+        Topic.objects.create(name="hello", code="b")
+
+        request = RequestFactory().post('/')
+        request.session = {}
+        request._messages = FallbackStorage(request)
+        admin = ArchivedModelAdmin(TopicArchive, site)
+        admin.restore_objects(request, Topic.objects.archived())
+
+        # the first gets a new slug, the second stays archived and is reported
+        restored = Topic.objects.get(pk=first.pk)
+        self.assertEqual((restored.slug, restored.is_active), ("hello-3", True))
+        self.assertEqual(list(Topic.objects.archived().values_list('pk', flat=True)), [second.pk])
+        self.assertEqual(len(list(request._messages)), 2)
+
+
+class UserModelAdminTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='editor', is_staff=True, is_superuser=True)
+        self.request = RequestFactory().post('/')
+        self.request.user = self.user
+        self.category = Category.objects.create(name='foobar')
+        self.post = Post.objects.create(category=self.category, name="post", body="body")
+        self.comments = [Comment.objects.create(post=self.post, name="comment", body=str(i)) for i in range(3)]
+
+    def _formset(self, new_rows):
+        admin = PostAdmin(Post, site)
+        inline = PostAdmin.CommentInline(Post, site)
+        FormSet = inline.get_formset(self.request, self.post, extra=new_rows)
+        prefix = FormSet.get_default_prefix()
+        data = {
+            '%s-TOTAL_FORMS' % prefix: len(self.comments) + new_rows,
+            '%s-INITIAL_FORMS' % prefix: len(self.comments),
+            '%s-MAX_NUM_FORMS' % prefix: 1000,
+        }
+        rows = [{'id': c.pk, 'name': c.name, 'slug': c.slug, 'body': c.body} for c in self.comments]
+        rows[0]['body'] = 'edited'
+        rows[1]['DELETE'] = 'on'
+        rows += [{'name': 'new comment', 'slug': 'new-comment-%d' % i, 'body': 'new'} for i in range(new_rows)]
+        for i, row in enumerate(rows):
+            row['post'] = self.post.pk
+            for key, value in row.items():
+                data['%s-%d-%s' % (prefix, i, key)] = value
+        formset = FormSet(data, instance=self.post, prefix=prefix)
+        self.assertTrue(formset.is_valid(), formset.errors)
+        return admin, formset
+
+    def test_bulk_save_formset(self):
+        admin, formset = self._formset(50)
+        # savepoint, delete (select + delete), bulk create (savepoint, slug lookup, insert,
+        # pk lookup, release), update, release
+        with self.assertNumQueries(10):
+            admin.save_formset(self.request, None, formset, True)
+
+        self.assertFalse(Comment.objects.filter(pk=self.comments[1].pk).exists())
+        edited = Comment.objects.get(pk=self.comments[0].pk)
+        self.assertEqual(edited.body, 'edited')
+        self.assertEqual(edited.updated_by, self.user)
+        self.assertEqual(Comment.cached.get(pk=edited.pk).body, 'edited')
+
+        created = Comment.objects.filter(name='new comment')
+        self.assertEqual(created.count(), 50)
+        self.assertEqual(len(set(created.values_list('slug', flat=True))), 50)
+        self.assertEqual(set(created.values_list('created_by', 'updated_by')), set([(self.user.pk, self.user.pk)]))
+
+    def test_bulk_save_formset_query_count_is_bounded(self):
+        admin, formset = self._formset(5)
+        with CaptureQueriesContext(connection) as small:
+            admin.save_formset(self.request, None, formset, True)
+        Comment.objects.filter(name='new comment').delete()
+        self.comments = list(Comment.objects.filter(post=self.post))
+
+        admin, formset = self._formset(200)
+        with CaptureQueriesContext(connection) as large:
+            admin.save_formset(self.request, None, formset, True)
+        self.assertEqual(len(large), len(small))
+
+
+class ChangeLogTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        for model in (Category, Comment):
+            model.change_log = True
+            self.addCleanup(delattr, model, 'change_log')
+        self.user = User.objects.create(username='editor', is_staff=True, is_superuser=True)
+
+    def test_save_and_delete_are_logged_as_diffs(self):
+        category = Category.objects.create(name='foobar', updated_by=self.user)
+        category = Category.objects.get(pk=category.pk)
+        category.name = 'renamed'
+        category.save()
+        category.save()
+        pk = category.pk
+        category.delete()
+
+        category.pk = pk
+        entries = list(ChangeLogEntry.objects.for_object(category))
+        self.assertEqual([entry.action for entry in entries],
+                         [ChangeLogEntry.ADDITION, ChangeLogEntry.CHANGE, ChangeLogEntry.DELETION])
+        self.assertEqual(entries[0].get_changes(), {'name': [None, 'foobar'], 'is_active': [None, True]})
+        self.assertEqual(entries[1].get_changes(), {'name': ['foobar', 'renamed']})
+        self.assertEqual(entries[1].user, self.user)
+        self.assertIsNone(entries[2].user)
+
+    def test_admin_formset_writes_one_insert(self):
+        request = RequestFactory().post('/')
+        request.user = self.user
+        post = Post.objects.create(category=Category.objects.create(name='foobar'), name="post", body="body")
+        comments = [Comment.objects.create(post=post, name="comment", body=str(i)) for i in range(2)]
+        ChangeLogEntry.objects.all().delete()
+
+        FormSet = PostAdmin.CommentInline(Post, site).get_formset(request, post, extra=2)
+        prefix = FormSet.get_default_prefix()
+        data = {'%s-TOTAL_FORMS' % prefix: 4, '%s-INITIAL_FORMS' % prefix: 2, '%s-MAX_NUM_FORMS' % prefix: 1000}
+        rows = [{'id': comments[0].pk, 'name': 'comment', 'slug': comments[0].slug, 'body': 'edited'},
+                {'id': comments[1].pk, 'name': 'comment', 'slug': comments[1].slug, 'body': '1', 'DELETE': 'on'},
+                {'name': 'new', 'slug': 'new-0', 'body': 'new'},
+                {'name': 'new', 'slug': 'new-1', 'body': 'new'}]
+        for i, row in enumerate(rows):
+            row['post'] = post.pk
+            for key, value in row.items():
+                data['%s-%d-%s' % (prefix, i, key)] = value
+        formset = FormSet(data, instance=post, prefix=prefix)
+        self.assertTrue(formset.is_valid(), formset.errors)
+
+        reset_queries()
+        with CaptureQueriesContext(connection) as queries:
+            PostAdmin(Post, site).save_formset(request, None, formset, True)
+        self.assertEqual(len([q for q in queries if 'INSERT INTO' in q['sql'] and 'changelogentry' in q['sql']]), 1)
+
+        self.assertEqual(sorted(ChangeLogEntry.objects.values_list('action', flat=True)),
+                         [ChangeLogEntry.ADDITION, ChangeLogEntry.ADDITION, ChangeLogEntry.CHANGE,
+                          ChangeLogEntry.DELETION])
+        change = ChangeLogEntry.objects.get(action=ChangeLogEntry.CHANGE)
+        self.assertEqual(change.get_changes(), {'body': ['0', 'edited']})
+        self.assertEqual(change.user, self.user)
+
+
+class ChangeListTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='editor', is_staff=True, is_superuser=True)
+        self.user.set_password('password')
+        self.user.save()
+        self.client.login(username='editor', password='password')
+        self.category = Category.objects.create(name='foobar')
+
+    def _create_posts(self, count):
+        for i in range(count):
+            user = User.objects.create(username='author %d' % Post.objects.count())
+            Post.objects.create(category=self.category, name="post", body="body", created_by=user, updated_by=user)
+
+    def test_changelist_query_count_does_not_depend_on_rows(self):
+        self._create_posts(2)
+        with CaptureQueriesContext(connection) as few:
+            response = self.client.get('/admin/test_project/post/')
+        self.assertEqual(response.status_code, 200)
+        self._create_posts(20)
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.get('/admin/test_project/post/')
+        self.assertContains(response, 'author 21')
+        self.assertEqual(len(many), len(few))
+
+    def test_changelist_loads_displayed_columns(self):
+        self._create_posts(1)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/admin/test_project/post/')
+        select = [q['sql'] for q in queries if 'FROM "test_project_post"' in q['sql'] and 'COUNT' not in q['sql']][0]
+        self.assertIn('"auth_user"', select)
+        self.assertNotIn('"test_project_post"."body"', select)
+        self.assertNotIn('"test_project_category"', select)
+
+    def test_approximate_count_paginator(self):
+        Post.objects.create(category=self.category, name="post", body="body")
+        paginator = ApproximateCountPaginator(Post.objects.all(), 10)
+        with self.assertNumQueries(1):
+            self.assertEqual(paginator.count, 1)
+
+        paginator = ApproximateCountPaginator(Post.objects.all(), 10)
+        paginator._estimate = lambda: 5000000
+        with self.assertNumQueries(0):
+            self.assertEqual(paginator.count, 5000000)
+        self.assertEqual(paginator.num_pages, 500000)
+
+        # filtered querysets are never estimated
+        paginator = ApproximateCountPaginator(Post.objects.filter(name="post"), 10)
+        self.assertIsNone(paginator._estimate())
+
+
+@skipIf(gather is None or not hasattr(OnlyOneActiveManager, 'aget_active'), "async methods need Python 3 and asgiref")
+class AsyncManagerTestCase(TransactionTestCase):
+    # async_to_sync() runs the sync_to_async() lookups back on this thread, so
+    # assertNumQueries() sees their queries
+
+    def setUp(self):
+        cache.clear()
+
+    @skipIf(not TASKS_SHARE_CALLER_THREAD, "needs asgiref >= 3.7")
+    def test_concurrent_aget_active_share_one_query(self):
+        from asgiref.sync import async_to_sync
+        active = Homepage.objects.create(hero="active", is_active=True)
+        Homepage.objects.create(hero="inactive", is_active=False)
+        cache.clear()
+
+        with self.assertNumQueries(1):
+            results = async_to_sync(gather)(*[Homepage.objects.aget_active for i in range(20)])
+        self.assertEqual(set(result.pk for result in results), set([active.pk]))
+
+        # later calls are served from the cache
+        with self.assertNumQueries(0):
+            self.assertEqual(async_to_sync(Homepage.objects.aget_active)(), active)
+
+    @skipIf(not TASKS_SHARE_CALLER_THREAD, "needs asgiref >= 3.7")
+    def test_concurrent_aget_by_natural_key_share_one_query(self):
+        from asgiref.sync import async_to_sync
+        category = Category.objects.create(name='foobar')
+        post = Post.objects.create(category=category, name="hello world", body="body")
+        cache.clear()
+
+        with self.assertNumQueries(1):
+            results = async_to_sync(gather)(*[lambda: Post.objects.aget_by_natural_key(post.slug) for i in range(20)])
+        self.assertEqual(set(result.pk for result in results), set([post.pk]))
+        self.assertEqual(cache.get(post.publish_key('slug')), post)
+
+    def test_aiter_active(self):
+        from asgiref.sync import async_to_sync
+        categories = [Category.objects.create(name="category %d" % i, is_active=i % 2 == 0) for i in range(5)]
+        # one query per full chunk, plus one for the last partial chunk
+        with self.assertNumQueries(2):
+            seen = async_to_sync(collect)(Category.objects.aiter_active(2))
+        self.assertEqual(seen, [c for c in categories if c.is_active])
+
+
+class ScheduledActiveTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.now = timezone.now()
+        self.default = Campaign.objects.create(hero="default", is_active=True)
+
+    def test_window_wins_while_open(self):
+        day, hour = datetime.timedelta(days=1), datetime.timedelta(hours=1)
+        Campaign.objects.create(hero="past", is_active=False, active_from=self.now - 2 * day,
+                                active_until=self.now - day)
+        sale = Campaign.objects.create(hero="sale", is_active=False, active_from=self.now - hour,
+                                       active_until=self.now + hour)
+        Campaign.objects.create(hero="later", is_active=False, active_from=self.now + day)
+        self.assertEqual(Campaign.objects.get_active(), sale)
+        self.assertTrue(Campaign.objects.get(pk=self.default.pk).is_active)
+
+        sale.active_until = self.now - datetime.timedelta(minutes=1)
+        sale.save()
+        self.assertEqual(Campaign.objects.get_active(), self.default)
+
+    def test_cancel_a_window(self):
+        sale = Campaign.objects.create(hero="sale", is_active=False, active_from=self.now - datetime.timedelta(hours=1))
+        # the window query, then the next opening and the next closing
+        with self.assertNumQueries(3):
+            self.assertEqual(Campaign.objects.get_active(), sale)
+
+        # scheduled rows are usually inactive already; clearing active_from closes the window
+        sale.active_from = None
+        sale.save()
+        self.assertEqual(Campaign.objects.get_active(), self.default)
+
+    @override_settings(BASIC_MODELS_DEFAULT_INDEXES=True)
+    def test_schedule_indexes(self):
+        self.assertEqual([index.fields for index in Campaign.get_raw_indexes() if index.fields[0].startswith('active_')],
+                         [['active_from'], ['active_until']])
+
+    def test_entry_is_refreshed_at_the_next_transition(self):
+        start = timezone.now() + datetime.timedelta(seconds=0.5)
+        sale = Campaign.objects.create(hero="sale", is_active=False, active_from=start)
+        key = Campaign.objects.active_cache_key()
+        self.assertEqual(Campaign.objects.get_active(), self.default)
+        self.assertAlmostEqual(cache.get(key)[1], calendar.timegm(start.utctimetuple()) + start.microsecond / 1e6)
+        with self.assertNumQueries(0):
+            self.assertEqual(Campaign.objects.get_active(), self.default)
+
+        # once the window opens the entry is rebuilt, without a save bumping its version
+        time.sleep(max(cache.get(key)[1] - time.time(), 0) + 0.05)
+        self.assertEqual(Campaign.objects.get_active(), sale)
+        self.assertEqual(Campaign.objects.active_cache_key(), key)
+        self.assertEqual(cache.get(key)[0], sale)
+
+    def test_clone_leaves_the_window(self):
+        sale = Campaign.objects.create(hero="sale", is_active=False, active_from=self.now - datetime.timedelta(hours=1))
+        copy = sale.clone()
+        self.assertIsNone(copy.active_from)
+        self.assertEqual(Campaign.objects.get_active(), sale)
+
+
+class WarmCachesTestCase(TransactionTestCase):
+
+    def setUp(self):
+        category = Category.objects.create(name='foobar')
+        self.homepage = Homepage.objects.create(hero="hero", is_active=True)
+        self.posts = [Post.objects.create(category=category, name="post %d" % i, body="body") for i in range(5)]
+        self.posts[0].is_active = False
+        self.posts[0].save()
+        cache.clear()
+
+    def assertWarm(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(Homepage.objects.get_active(), self.homepage)
+            for post in self.posts[1:]:
+                self.assertEqual(Post.objects.get_by_natural_key(post.slug), post)
+                self.assertEqual(Post.cached.get(pk=post.pk), post)
+        self.assertIsNone(cache.get(self.posts[0].publish_key('slug')))
+
+    def test_warm_caches(self):
+        counts = warm_caches(chunk_size=2)
+        self.assertEqual(counts['test_project.post'], 4)
+        self.assertEqual(counts['test_project.homepage'], 0)
+        self.assertWarm()
+
+    def test_warm_caches_per_scope(self):
+        sites = [Site.objects.create(domain='%d.example.com' % i) for i in range(2)]
+        banners = [Banner.objects.create(site=site, text="banner", is_active=True) for site in sites]
+        warm_caches([Banner])
+        with self.assertNumQueries(0):
+            for site, banner in zip(sites, banners):
+                self.assertEqual(Banner.objects.get_active(site=site), banner)
+
+    @skipIf(connection.vendor == 'sqlite' and connection.settings_dict['TEST']['NAME'] in (None, '', ':memory:'),
+            "threads can't share an in-memory sqlite database")
+    def test_warm_caches_in_parallel(self):
+        warm_caches(workers=3)
+        self.assertWarm()
+
+    def test_command(self):
+        out = StringIO()
+        call_command('warm_basic_models_cache', 'test_project.Post', '--all', stdout=out)
+        self.assertIn("test_project.post: 5 rows published", out.getvalue())
+        self.assertIsNotNone(cache.get(self.posts[0].publish_key('slug')))
+        self.assertIsNone(cache.get(Homepage.objects.active_cache_key()))
+
+
+@skipIf(connection.vendor == 'sqlite' and connection.settings_dict['TEST']['NAME'] in (None, '', ':memory:'),
+        "threads can't share an in-memory sqlite database")
+class OnlyOneActiveConcurrencyTestCase(TransactionTestCase):
+
+    def test_concurrent_activation(self):
+        homepages = [Homepage.objects.create(hero=str(i), is_active=False) for i in range(5)]
+        errors = []
+
+        def activate_randomly():
+            try:
+                for i in range(20):
+                    home = Homepage.objects.get(pk=random.choice(homepages).pk)
+                    home.is_active = True
+                    home.save()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=activate_randomly) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(Homepage.objects.filter(is_active=True).count(), 1)
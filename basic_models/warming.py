@@ -0,0 +1,97 @@
+# Copyright 2011 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Prefill the caches after a deploy or a cache restart, before the traffic does.
+
+    from basic_models.warming import warm_caches
+    warm_caches()                      # every OnlyOneActiveModel and SlugModel
+    warm_caches([Homepage, Post], chunk_size=1000, workers=4)
+
+or `manage.py warm_basic_models_cache`.
+"""
+
+import time
+from multiprocessing.pool import ThreadPool
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connections
+
+from basic_models.caching import set_many
+from basic_models.instrumentation import get_collector, model_label
+from basic_models.models import OnlyOneActiveModel, SlugModel
+
+
+def warmable_models():
+    """Return every concrete OnlyOneActiveModel and SlugModel subclass"""
+    return [model for model in apps.get_models()
+            if issubclass(model, (OnlyOneActiveModel, SlugModel)) and not model._meta.proxy]
+
+
+def warm_caches(models=None, chunk_size=500, workers=1, active_only=True):
+    """Cache the get_active() result of each OnlyOneActiveModel scope and publish the rows of each SlugModel.
+
+    Rows are read in keyset chunks of chunk_size and published with one
+    publish_many() per chunk, so memory stays bounded however large the
+    table. With workers > 1 the models are warmed in parallel threads. Set
+    active_only=False to publish inactive SlugModel rows too. Returns a
+    {'app_label.model_name': rows published} dict.
+    """
+    if models is None:
+        models = warmable_models()
+
+    def warm(model):
+        try:
+            return _warm_model(model, chunk_size, active_only)
+        finally:
+            if workers > 1:
+                # each thread opened its own connections
+                for connection in connections.all():
+                    connection.close()
+
+    if workers > 1:
+        pool = ThreadPool(min(workers, len(models)) or 1)
+        try:
+            results = pool.map(warm, models)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [warm(model) for model in models]
+
+    active_entries = dict(entry for entries, count in results for entry in entries)
+    if active_entries:
+        timeout = getattr(settings, "DEFAULT_CACHE_TIMEOUT", 900)
+        set_many(active_entries, timeout + getattr(settings, 'BASIC_MODELS_STALE_TIMEOUT', 60))
+    return dict((model_label(model), count) for model, (entries, count) in zip(models, results))
+
+
+def _warm_model(model, chunk_size, active_only):
+    # returns (the get_active() (key, value) of each scope, rows published)
+    start = time.time()
+    entries = []
+    count = 0
+    if issubclass(model, OnlyOneActiveModel):
+        entries = [model.objects.active_cache_entry(**scope) for scope in model.objects.active_scopes()]
+    if issubclass(model, SlugModel):
+        queryset = model._default_manager.all()
+        chunks = queryset.iter_active_chunks(chunk_size) if active_only else queryset.iter_chunks(chunk_size)
+        for chunk in chunks:
+            model.publish_many(chunk)
+            count += len(chunk)
+    collector = get_collector()
+    if collector is not None:
+        collector.incr('warm.rows', count, model_label(model))
+        collector.timing('warm.model', time.time() - start, model_label(model))
+    return entries, count
@@ -0,0 +1,580 @@
+#!/usr/bin/env python
+"""Benchmarks for the basic_models hot paths.
+
+Runs against a throwaway SQLite test database and a locmem cache, so it needs
+no external services:
+
+    python benchmarks.py                        # run everything
+    python benchmarks.py get_active             # run the benchmarks whose name contains "get_active"
+    python benchmarks.py --sizes 100,1000,10000 # data sizes for the benchmarks that take them
+    python benchmarks.py --json results.json    # also write the results as JSON, for diffing releases
+    python benchmarks.py --json - > out.json    # the results as JSON on stdout, the report on stderr
+"""
+import argparse
+import collections
+import json
+import os
+import platform
+import sys
+import time
+
+
+BENCHMARKS = []
+RESULTS = []
+CURRENT = [None]
+# where the report lines go; stderr when the JSON results go to stdout
+OUTPUT = [sys.stdout]
+
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+
+def timed(func, number=1000):
+    """Return the mean wall time of func() in microseconds"""
+    start = time.time()
+    for i in range(number):
+        func()
+    return (time.time() - start) / number * 1e6
+
+
+def measure(func, number=1):
+    """Return (mean wall time of func() in microseconds, mean queries per call)"""
+    from django.db import connection, reset_queries
+    from django.test.utils import CaptureQueriesContext
+
+    # the query log is a bounded deque; start from empty so the count can't saturate
+    reset_queries()
+    with CaptureQueriesContext(connection) as queries:
+        elapsed = timed(func, number)
+    return elapsed, len(queries) / float(number)
+
+
+def report(name, value, unit='us', size=None, queries=None):
+    RESULTS.append({'benchmark': CURRENT[0], 'name': name, 'size': size,
+                    'value': value, 'unit': unit, 'queries': queries})
+    label = name if size is None else "%s [%d]" % (name, size)
+    line = "%-60s %12.2f %s" % (label, value, unit)
+    if queries is not None:
+        line += "  (%g queries)" % queries
+    say(line)
+
+
+def say(line):
+    OUTPUT[0].write(line + "\n")
+
+
+@benchmark
+def get_active_local_cache(sizes):
+    from django.core.cache import cache
+    from django.test.utils import override_settings
+    from test_project.models import Homepage
+
+    Homepage.objects.create(hero="<h1>%s</h1>" % ("x" * 20000), is_active=True)
+    cache.clear()
+
+    Homepage.objects.get_active()
+    report("get_active: shared cache hit", timed(Homepage.objects.get_active))
+
+    with override_settings(BASIC_MODELS_LOCAL_CACHE={'GRACE': 0}):
+        Homepage.objects.get_active()
+        report("get_active: local hit, version checked", timed(Homepage.objects.get_active))
+
+    with override_settings(BASIC_MODELS_LOCAL_CACHE={'GRACE': 60}):
+        Homepage.objects.get_active()
+        report("get_active: local hit within grace window", timed(Homepage.objects.get_active))
+
+    Homepage.objects.all().delete()
+
+
+@benchmark
+def get_active_miss_100k(sizes):
+    from test_project.models import Homepage
+
+    Homepage.objects.bulk_create(
+        Homepage(hero="<p>%d</p>%s" % (i, "x" * 500), is_active=False) for i in range(100000))
+
+    def legacy_find_active():
+        # get_active() before it used LIMIT 1: materializes every candidate row
+        active = Homepage.objects.filter(is_active=True).order_by('-updated_at')
+        if len(active) < 1:
+            active = Homepage.objects.all().order_by('-updated_at')
+            if len(active) < 1:
+                return None
+        return active[0]
+
+    report("get_active miss, no active row (legacy len())", timed(legacy_find_active, 5) / 1000, 'ms')
+    report("get_active miss, no active row", timed(Homepage.objects._find_active, 100) / 1000, 'ms')
+
+    active = Homepage.objects.order_by('?')[0]
+    active.is_active = True
+    active.save()
+    report("get_active miss, active row (legacy len())", timed(legacy_find_active, 100) / 1000, 'ms')
+    report("get_active miss, active row", timed(Homepage.objects._find_active, 100) / 1000, 'ms')
+
+    Homepage.objects.all().delete()
+
+
+@benchmark
+def cache_payload(sizes):
+    import pickle
+    from django.core.cache import cache
+    from django.test.utils import override_settings
+    from basic_models.caching import packing
+    from test_project.models import Category, Comment, Post
+
+    category = Category.objects.create(name="category")
+
+    def stored_bytes(value):
+        # what a pickling backend (locmem, memcached, redis) stores and sends
+        with packing():
+            return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    for size in sizes:
+        # size words of body text; Comment caches its body under a key of its own
+        body = " ".join("word%d" % (i % 500) for i in range(size))
+        post = Post.objects.create(category=category, name="post", body=body)
+        comment = Comment.objects.create(post=post, name="comment", body=body)
+        for threshold, label in ((None, ""), (1024, ", compressed from 1KB")):
+            with override_settings(BASIC_MODELS_CACHE_COMPRESS_THRESHOLD=threshold):
+                cache.clear()
+                post.publish()
+                comment.publish()
+                report("cached Post, every field%s" % label, stored_bytes(post), 'bytes', size)
+                report("cached Comment, body split out%s" % label, stored_bytes(comment), 'bytes', size)
+                report("split Comment.body entry%s" % label,
+                       stored_bytes(list(comment.split_field_items().values())[0]), 'bytes', size)
+
+                post_key, comment_key = post.publish_key('pk'), comment.publish_key('pk')
+                report("cache.get(), read name, every field%s" % label,
+                       timed(lambda: cache.get(post_key).name), size=size)
+                report("cache.get(), read name, body split out%s" % label,
+                       timed(lambda: cache.get(comment_key).name), size=size)
+                report("cache.get(), read body, body split out%s" % label,
+                       timed(lambda: cache.get(comment_key).body), size=size)
+
+    Comment.objects.all().delete()
+    Post.objects.all().delete()
+    Category.objects.all().delete()
+
+
+@benchmark
+def manager_proxy_overhead(sizes):
+    from django.db import models
+    from django.db.models.query import QuerySet
+    from basic_models.managers import ActiveQuerySet
+    from test_project.models import Category
+
+    class LegacyManager(models.Manager):
+        # the manager before proxies were generated with from_queryset()
+        def get_queryset(self):
+            return ActiveQuerySet(self.model)
+
+        def __getattr__(self, attr, *args):
+            if attr.startswith('_'):
+                raise AttributeError
+            return getattr(self.get_queryset(), attr, *args)
+
+    legacy = LegacyManager()
+    legacy.model = Category
+
+    report("objects.active() (legacy __getattr__)", timed(lambda: legacy.active(), 20000))
+    report("objects.active()", timed(lambda: Category.objects.active(), 20000))
+    report("active_objects.all()", timed(lambda: Category.active_objects.all(), 20000))
+    report("hasattr(objects, missing) (legacy __getattr__)", timed(lambda: hasattr(legacy, 'missing'), 20000))
+    report("hasattr(objects, missing)", timed(lambda: hasattr(Category.objects, 'missing'), 20000))
+
+
+@benchmark
+def loaddata_natural_keys_50k(sizes):
+    from django.core import serializers
+    from django.core.cache import cache
+    from basic_models.managers import SlugModelManager
+    from test_project.models import Category, Comment, Post
+
+    category = Category.objects.create(name="benchmark")
+    posts = [Post.objects.create(category=category, name="post %d" % i, body="body") for i in range(500)]
+    cache.clear()
+    Comment.objects.bulk_create(
+        Comment(post=posts[i % len(posts)], name="comment %d" % i, slug="comment-%d" % i, body="body")
+        for i in range(50000))
+    fixture = serializers.serialize('json', Comment.objects.all(),
+                                    use_natural_foreign_keys=True, use_natural_primary_keys=True)
+
+    def deserialize():
+        for obj in serializers.deserialize('json', fixture):
+            pass
+
+    def uncached_get_by_natural_key(self, slug):
+        return self.get(slug=slug)
+
+    cached_get_by_natural_key = SlugModelManager.get_by_natural_key
+    SlugModelManager.get_by_natural_key = uncached_get_by_natural_key
+    try:
+        report("deserialize 50k comments (uncached lookups)", timed(deserialize, 1) / 1e6, 's')
+    finally:
+        SlugModelManager.get_by_natural_key = cached_get_by_natural_key
+
+    cache.clear()
+    report("deserialize 50k comments (cold cache)", timed(deserialize, 1) / 1e6, 's')
+    report("deserialize 50k comments (warm cache)", timed(deserialize, 1) / 1e6, 's')
+
+    Comment.objects.all().delete()
+    Post.objects.all().delete()
+    category.delete()
+
+
+@benchmark
+def bulk_slug_generation(sizes):
+    from test_project.models import Category, Post
+
+    category = Category.objects.create(name="benchmark")
+
+    for size in sizes:
+        # save() probes every candidate suffix, so rows sharing a title cost O(n^2)
+        # queries; past a few hundred rows the baseline takes minutes
+        if size <= 300:
+            elapsed, queries = measure(lambda: [
+                Post.objects.create(category=category, name="Shared title", body="body") for i in range(size)])
+            report("save() posts sharing a title", elapsed / 1e6, 's', size, queries)
+            Post.objects.all().delete()
+
+        elapsed, queries = measure(lambda: Post.objects.bulk_create_with_slugs(
+            Post(category=category, name="Shared title", body="body") for i in range(size)))
+        report("bulk_create_with_slugs posts sharing a title", elapsed / 1e6, 's', size, queries)
+        Post.objects.all().delete()
+
+        titles = max(size // 10, 1)
+        elapsed, queries = measure(lambda: Post.objects.bulk_create_with_slugs(
+            Post(category=category, name="Title %d" % (i % titles), body="body") for i in range(size)))
+        report("bulk_create_with_slugs, 10 posts per title", elapsed / 1e6, 's', size, queries)
+        Post.objects.all().delete()
+    category.delete()
+
+
+@benchmark
+def model_save(sizes):
+    from test_project.models import Category, Homepage, Post
+
+    category = Category.objects.create(name="benchmark")
+    for size in sizes:
+        names = iter(range(size))
+        elapsed, queries = measure(
+            lambda: Post.objects.create(category=category, name="post %d" % next(names), body="body"), size)
+        report("SlugModel save(), new row with a unique title", elapsed, 'us', size, queries)
+        Post.objects.all().delete()
+
+        Homepage.objects.bulk_create(Homepage(hero=str(i), is_active=False) for i in range(size))
+        homepages = list(Homepage.objects.all())
+        rows = iter(homepages * 2)
+
+        def activate():
+            home = next(rows)
+            home.is_active = True
+            home.save()
+        elapsed, queries = measure(activate, min(size, 200))
+        report("OnlyOneActiveModel save(), activating a row", elapsed, 'us', size, queries)
+
+        active = Homepage.objects.get(is_active=True)
+        elapsed, queries = measure(active.save, 200)
+        report("OnlyOneActiveModel save(), row already active", elapsed, 'us', size, queries)
+        Homepage.objects.all().delete()
+    category.delete()
+
+
+@benchmark
+def get_active_hit_miss(sizes):
+    from django.core.cache import cache
+    from test_project.models import Homepage
+
+    for size in sizes:
+        Homepage.objects.bulk_create(Homepage(hero=str(i), is_active=False) for i in range(size))
+        home = Homepage.objects.order_by('pk')[size // 2]
+        home.is_active = True
+        home.save()
+
+        def miss():
+            Homepage.objects.invalidate_active()
+            Homepage.objects.get_active()
+        elapsed, queries = measure(miss, 200)
+        report("get_active() miss", elapsed, 'us', size, queries)
+
+        Homepage.objects.get_active()
+        elapsed, queries = measure(Homepage.objects.get_active, 2000)
+        report("get_active() hit", elapsed, 'us', size, queries)
+        Homepage.objects.all().delete()
+        cache.clear()
+
+
+@benchmark
+def get_active_prefetch(sizes):
+    from django.core.cache import cache
+    from test_project.models import Category, Homepage, Post
+
+    categories = [Category.objects.create(name="category %d" % i) for i in range(10)]
+    for size in sizes:
+        # size posts on the homepage
+        Post.objects.bulk_create_with_slugs(
+            Post(category=categories[i % 10], name="post %d" % i, body="body") for i in range(size))
+        home = Homepage.objects.create(hero="hero", is_active=True)
+        home.posts.add(*Post.objects.all())
+
+        for prefetch in ([], ['posts__category']):
+            def render():
+                active = Homepage.objects.get_active(prefetch=prefetch)
+                return [(post.name, post.category.name) for post in active.posts.all()]
+            render()
+            elapsed, queries = measure(render, 20)
+            report("render get_active() hit, prefetch=%r" % prefetch, elapsed, 'us', size, queries)
+
+        Homepage.objects.all().delete()
+        Post.objects.all().delete()
+        cache.clear()
+    Category.objects.all().delete()
+
+
+@benchmark
+def clone_with_relations(sizes):
+    from test_project.models import Category, Homepage, HomepageSection, Post
+
+    category = Category.objects.create(name="benchmark")
+    for size in sizes:
+        home = Homepage.objects.create(hero="hero", is_active=True)
+        HomepageSection.objects.bulk_create(HomepageSection(homepage=home, title=str(i)) for i in range(size))
+        Post.objects.bulk_create_with_slugs(Post(category=category, name="post %d" % i, body="body") for i in range(size))
+        home.posts.add(*Post.objects.all())
+
+        elapsed, queries = measure(home.clone)
+        report("clone(), sections and m2m posts per homepage", elapsed / 1000, 'ms', size, queries)
+        HomepageSection.objects.all().delete()
+        Homepage.objects.all().delete()
+        Post.objects.all().delete()
+    category.delete()
+
+
+@benchmark
+def admin_bulk_actions(sizes):
+    from django.contrib.admin import site
+    from django.contrib.messages.storage.fallback import FallbackStorage
+    from django.test import RequestFactory
+    from basic_models.admin import ActiveModelAdmin
+    from test_project.models import Category, Post
+
+    request = RequestFactory().post('/')
+    request.session = {}
+    request._messages = FallbackStorage(request)
+    admin = ActiveModelAdmin(Post, site)
+    category = Category.objects.create(name="benchmark")
+    for size in sizes:
+        Post.objects.bulk_create_with_slugs(Post(category=category, name="post %d" % i, body="body") for i in range(size))
+        Post.objects.all().publish()
+
+        elapsed, queries = measure(lambda: admin.deactivate_objects(request, Post.objects.all()))
+        report("deactivate_objects admin action", elapsed / 1000, 'ms', size, queries)
+        elapsed, queries = measure(lambda: admin.activate_objects(request, Post.objects.all()))
+        report("activate_objects admin action", elapsed / 1000, 'ms', size, queries)
+        Post.objects.all().delete()
+    category.delete()
+
+
+@benchmark
+def save_formset_inlines(sizes):
+    from django.contrib.admin import site
+    from django.contrib.auth.models import User
+    from django.test import RequestFactory
+    from test_project.admin import PostAdmin
+    from test_project.models import Category, Comment, Post
+
+    user = User.objects.create(username="benchmark", is_staff=True, is_superuser=True)
+    request = RequestFactory().post('/')
+    request.user = user
+    category = Category.objects.create(name="benchmark")
+    post = Post.objects.create(category=category, name="post", body="body")
+
+    def formset(size):
+        comments = list(Comment.objects.filter(post=post).order_by('pk'))
+        FormSet = PostAdmin.CommentInline(Post, site).get_formset(request, post, extra=size)
+        prefix = FormSet.get_default_prefix()
+        data = {'%s-TOTAL_FORMS' % prefix: len(comments) + size, '%s-INITIAL_FORMS' % prefix: len(comments),
+                '%s-MAX_NUM_FORMS' % prefix: 100000}
+        # every existing row edited, plus size new rows
+        rows = [{'id': c.pk, 'name': c.name, 'slug': c.slug, 'body': 'edited'} for c in comments]
+        rows += [{'name': 'comment', 'slug': 'comment-%d-%d' % (len(comments), i), 'body': 'new'} for i in range(size)]
+        for i, row in enumerate(rows):
+            row['post'] = post.pk
+            for key, value in row.items():
+                data['%s-%d-%s' % (prefix, i, key)] = value
+        result = FormSet(data, instance=post, prefix=prefix)
+        assert result.is_valid(), result.errors
+        return result
+
+    for bulk in (False, True):
+        admin = PostAdmin(Post, site)
+        admin.bulk_save_formsets = bulk
+        label = "bulk save_formset" if bulk else "per-row save_formset"
+        for size in sizes:
+            new = formset(size)
+            elapsed, queries = measure(lambda: admin.save_formset(request, None, new, False))
+            report("%s, new inline rows" % label, elapsed / 1000, 'ms', size, queries)
+            changed = formset(0)
+            elapsed, queries = measure(lambda: admin.save_formset(request, None, changed, True))
+            report("%s, changed inline rows" % label, elapsed / 1000, 'ms', size, queries)
+            Comment.objects.all().delete()
+    post.delete()
+    category.delete()
+    user.delete()
+
+
+@benchmark
+def change_log(sizes):
+    from basic_models.changelog import batch_changes
+    from basic_models.models import ChangeLogEntry
+    from test_project.models import Category
+
+    def edit_all(categories, suffix):
+        for category in categories:
+            category.name = "category %s" % suffix
+            category.save()
+
+    for size in sizes:
+        Category.objects.bulk_create(Category(name="category") for i in range(size))
+        categories = list(Category.objects.all())
+        elapsed, queries = measure(lambda: edit_all(categories, 'a'))
+        report("save() every row, no change log", elapsed / size, 'us', size, queries / size)
+
+        Category.change_log = True
+        try:
+            categories = list(Category.objects.all())
+            # outside a transaction each save() writes its own entry, like a post_save receiver
+            elapsed, queries = measure(lambda: edit_all(categories, 'b'))
+            report("save() every row, one log INSERT per save", elapsed / size, 'us', size, queries / size)
+
+            def batched():
+                with batch_changes():
+                    edit_all(categories, 'c')
+            elapsed, queries = measure(batched)
+            report("save() every row, log written in bulk", elapsed / size, 'us', size, queries / size)
+        finally:
+            del Category.change_log
+        ChangeLogEntry.objects.all().delete()
+        Category.objects.all().delete()
+
+
+@benchmark
+def default_indexes_1m(sizes):
+    from django.contrib.auth.models import User
+    from django.db import connection
+    from django.test.utils import override_settings
+    from basic_models.indexes import create_raw_indexes
+    from test_project.models import Category
+
+    users = [User.objects.create(username="user %d" % i) for i in range(100)]
+    first_user = users[0].pk
+    with connection.cursor() as cursor:
+        # SQLite only, like the EXPLAIN QUERY PLAN output below; generating the
+        # rows in SQL is much faster than a million bulk_create() objects
+        cursor.execute(
+            "WITH RECURSIVE seq(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM seq WHERE i < 1000000) "
+            "INSERT INTO test_project_category (name, is_active, created_by_id, created_at, updated_at) "
+            "SELECT 'category ' || i, i %% 10 = 0, %s + i %% 100, "
+            "datetime('now', '-' || (i * 104729 %% 1000000) || ' seconds'), "
+            "datetime('now', '-' || (i * 7919 %% 1000000) || ' seconds') FROM seq", [first_user])
+        cursor.execute("ANALYZE")
+
+    user = users[42]
+    queries = [
+        ("active_objects newest 20", lambda: list(Category.active_objects.order_by('-updated_at')[:20])),
+        ("most recently updated, active first", lambda: Category.objects.order_by('-is_active', '-updated_at').first()),
+        ("created by user, newest 20", lambda: list(Category.objects.filter(created_by=user).order_by('-created_at')[:20])),
+    ]
+
+    def plan(queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            return "; ".join(row[-1] for row in cursor.fetchall())
+
+    plans = [
+        Category.active_objects.order_by('-updated_at')[:20],
+        Category.objects.order_by('-is_active', '-updated_at')[:1],
+        Category.objects.filter(created_by=user).order_by('-created_at')[:20],
+    ]
+
+    default_indexes = override_settings(BASIC_MODELS_DEFAULT_INDEXES=True)
+    with default_indexes:
+        names = [index.get_name(Category, connection) for index in Category.get_raw_indexes()]
+    with connection.cursor() as cursor:
+        for name in names:
+            cursor.execute("DROP INDEX IF EXISTS %s" % connection.ops.quote_name(name))
+    for (name, query), queryset in zip(queries, plans):
+        report("%s, no default indexes" % name, timed(query, 5) / 1000, 'ms')
+        say("    %s" % plan(queryset))
+
+    with default_indexes:
+        create_raw_indexes(Category)
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
+    for (name, query), queryset in zip(queries, plans):
+        report("%s, default indexes" % name, timed(query, 100) / 1000, 'ms')
+        say("    %s" % plan(queryset))
+
+    with connection.cursor() as cursor:
+        # Category.objects.all().delete() would collect a million rows first
+        cursor.execute("DELETE FROM test_project_category")
+    User.objects.all().delete()
+
+
+if __name__ == "__main__":
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "test_project.settings")
+
+    parser = argparse.ArgumentParser(description="Benchmark the basic_models hot paths.")
+    parser.add_argument('names', nargs='*', help="only run the benchmarks whose name contains one of these")
+    parser.add_argument('--sizes', default='100,1000', help="comma separated data sizes (default 100,1000)")
+    parser.add_argument('--json', metavar='PATH', help="write the results as JSON to PATH, or - for stdout")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    if args.json == '-':
+        OUTPUT[0] = sys.stderr
+
+    import django
+    django.setup()
+    from django.db import connection
+    from django.test.runner import DiscoverRunner
+    from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+    selected = [b for b in BENCHMARKS if not args.names or any(name in b.__name__ for name in args.names)]
+
+    # the default locmem cache culls at 300 entries, far fewer than the benchmarks publish
+    with override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': 1000000},
+    }}):
+        setup_test_environment()
+        runner = DiscoverRunner(verbosity=0)
+        old_config = runner.setup_databases()
+        if hasattr(connection, 'queries_log'):
+            # the query log keeps 9000 entries, fewer than the per-row baselines run
+            connection.queries_log = collections.deque(maxlen=10 ** 7)
+        try:
+            for bench in selected:
+                CURRENT[0] = bench.__name__
+                bench(sizes)
+        finally:
+            runner.teardown_databases(old_config)
+            teardown_test_environment()
+
+    if args.json:
+        output = json.dumps({
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'database_version': connection.Database.sqlite_version if connection.vendor == 'sqlite' else None,
+            'sizes': sizes,
+            'results': RESULTS,
+        }, indent=2, sort_keys=True)
+        if args.json == '-':
+            print(output)
+        else:
+            with open(args.json, 'w') as f:
+                f.write(output)
@@ -6,6 +6,7 @@ from django.contrib import admin
 from test_project.models import *
 
 admin.site.register(Category, admin.ModelAdmin)
+admin.site.register(CategoryArchive, basic_models.ArchivedModelAdmin)
 
 class PostAdmin(basic_models.SlugModelAdmin):
     class CommentInline(admin.TabularInline):
@@ -13,6 +14,9 @@ class PostAdmin(basic_models.SlugModelAdmin):
         fields = ('name','slug','body')
         extra = 2
     inlines = [CommentInline]
+    list_display = ('name', 'slug', 'created_by', 'updated_by', 'is_active')
+    list_filter = ('created_by',)
+    bulk_save_formsets = True
 admin.site.register(Post, PostAdmin)
 
 admin.site.register(Comment, admin.ModelAdmin)
@@ -0,0 +1,18 @@
+"""Coroutine helpers for the async tests; Python 3 only"""
+import asyncio
+
+import asgiref
+
+# asgiref < 3.7 tracks async_to_sync()'s calling thread per task, so the
+# sync_to_async() calls of tasks started by gather() run in a worker thread
+# and assertNumQueries() on the test thread can't see their queries
+TASKS_SHARE_CALLER_THREAD = tuple(int(part) for part in asgiref.__version__.split('.')[:2]) >= (3, 7)
+
+
+async def gather(*calls):
+    """Await every call() at once on the running loop"""
+    return await asyncio.gather(*[call() for call in calls])
+
+
+async def collect(aiterable):
+    return [item async for item in aiterable]
@@ -1,3 +1,5 @@
+import uuid
+from datetime import timedelta
 
 from django.db import models
 import basic_models
@@ -5,7 +7,9 @@ import basic_models
 
 class Category(basic_models.DefaultModel):
     name = models.CharField(max_length=1024)
-    pass
+
+    cache_fields = ('name',)
+    archive_after = timedelta(days=365)
 
 
 class Post(basic_models.SlugModel):
@@ -16,6 +20,36 @@ class Comment(basic_models.SlugModel):
     post = models.ForeignKey(Post)
     body = models.TextField()
 
-class Homepage(basic_models.OnlyOneActiveModel):
+    cache_split_fields = ('body',)
+
+class Homepage(basic_models.OnlyOneActiveModel, basic_models.TimestampedModel):
+    hero = models.TextField()
+    posts = models.ManyToManyField(Post, blank=True)
+
+    active_index = True
+
+class HomepageSection(models.Model):
+    homepage = models.ForeignKey(Homepage, related_name='sections')
+    title = models.CharField(max_length=255)
+
+class Site(models.Model):
+    domain = models.CharField(max_length=255)
+
+class Banner(basic_models.OnlyOneActiveModel, basic_models.TimestampedModel):
+    site = models.ForeignKey(Site)
+    text = models.TextField()
+
+    active_scope = ('site',)
+    active_index = True
+
+class Campaign(basic_models.OnlyOneActiveModel, basic_models.ScheduledModel, basic_models.TimestampedModel):
     hero = models.TextField()
-    posts = models.ManyToManyField(Post, blank=True)
\ No newline at end of file
+
+class Tag(basic_models.ActiveModel, basic_models.TimestampedModel):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    name = models.CharField(max_length=255)
+
+class Topic(basic_models.SlugModel):
+    code = models.CharField(max_length=20, unique=True, null=True, blank=True)
+
+    archive_after = timedelta(days=365)
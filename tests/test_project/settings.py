@@ -17,6 +17,10 @@ DATABASES = {
         'PASSWORD': '',                  # Not used with sqlite3.
         'HOST': '',                      # Set to empty string for localhost. Not used with sqlite3.
         'PORT': '',                      # Set to empty string for default. Not used with sqlite3.
+        'TEST': {
+            # a file rather than :memory: so threaded tests can share the test database
+            'NAME': 'test_project_test.sqlite3',
+        },
     }
 }
 